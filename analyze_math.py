@@ -0,0 +1,342 @@
+#!/usr/bin/python
+"""
+Summarize math distraction logs.
+
+Reads the math.log (and, if present, session.log) written by
+math_distract and distract_pres for each session, and computes
+accuracy, reaction times, problems attempted, rest time, and timeout
+rates for each distraction period (set). Sessions are processed in
+parallel, and logs are parsed one line at a time, so memory use does
+not depend on the number or size of the logs.
+
+Sessions are expected in the standard PyEPL layout,
+[data]/[subject]/session_[n]/math.log.
+
+Example:
+python analyze_math.py data -o math_sets.csv -s math_subjects.csv -j 8
+"""
+
+import os
+import csv
+import math
+import argparse
+import multiprocessing
+
+# columns of the table of sets
+SET_COLUMNS = ('subject', 'session', 'set', 'n_problems', 'n_correct',
+               'n_incorrect', 'n_timeout', 'accuracy', 'timeout_rate',
+               'rt_mean', 'rt_median', 'rt_sd', 'rt_min', 'rt_max',
+               'duration', 'rest_time', 'session_problems',
+               'session_correct')
+
+# columns of the table of subjects
+SUBJECT_COLUMNS = ('subject', 'n_sessions', 'n_sets', 'n_problems',
+                   'n_correct', 'n_incorrect', 'n_timeout', 'accuracy',
+                   'timeout_rate', 'rt_mean', 'rt_median_mean',
+                   'rest_time_mean')
+
+def parse_log_line(line):
+    """
+    Split a line of a PyEPL log.
+
+    Outputs
+    -------
+    time : int
+    event : str
+    fields : list of strs
+        Fields following the event type.
+    """
+
+    parts = line.rstrip('\r\n').split('\t')
+    if len(parts) < 3:
+        return None, None, []
+    try:
+        time = int(parts[0])
+    except ValueError:
+        return None, None, []
+    return time, parts[2], parts[3:]
+
+def _rt_stats(rts):
+    """
+    Get the mean, median, sd, min, and max of a list of RTs.
+    """
+
+    n = len(rts)
+    if n == 0:
+        return (None,) * 5
+    rts = sorted(rts)
+    mean = float(sum(rts)) / n
+    if n % 2:
+        median = float(rts[n // 2])
+    else:
+        median = (rts[n // 2 - 1] + rts[n // 2]) / 2.0
+    if n > 1:
+        sd = math.sqrt(sum((x - mean) ** 2 for x in rts) / (n - 1))
+    else:
+        sd = None
+    return mean, median, sd, rts[0], rts[-1]
+
+class _SetSummary(object):
+    """
+    Running summary of one set.
+    """
+
+    def __init__(self):
+        self.n_correct = 0
+        self.n_incorrect = 0
+        self.n_timeout = 0
+        self.rts = []
+        self.start = None
+        self.rest = None
+        self.end = None
+
+    def row(self, subject, session, set_num, session_counts):
+        n_problems = self.n_correct + self.n_incorrect + self.n_timeout
+        n_responses = self.n_correct + self.n_incorrect
+        if n_responses:
+            accuracy = float(self.n_correct) / n_responses
+        else:
+            accuracy = None
+        if n_problems:
+            timeout_rate = float(self.n_timeout) / n_problems
+        else:
+            timeout_rate = None
+        if self.start is not None and self.end is not None:
+            duration = self.end - self.start
+        else:
+            duration = None
+        if self.rest is not None and self.end is not None:
+            rest_time = self.end - self.rest
+        else:
+            rest_time = 0
+        logged = session_counts.get(set_num, (None, None))
+        return ((subject, session, set_num, n_problems, self.n_correct,
+                 self.n_incorrect, self.n_timeout, accuracy,
+                 timeout_rate) + _rt_stats(self.rts) +
+                (duration, rest_time) + logged)
+
+def read_session_log(filename):
+    """
+    Read the number of problems and correct responses logged for
+    each set in a session.log.
+
+    Outputs
+    -------
+    counts : dict
+        (n_problems, n_correct) for each set number.
+    """
+
+    counts = {}
+    if not os.path.exists(filename):
+        return counts
+    with open(filename) as f:
+        for line in f:
+            time, event, fields = parse_log_line(line)
+            if event == 'DISTRACTOR' and len(fields) >= 3:
+                counts[int(fields[0])] = (int(fields[1]), int(fields[2]))
+    return counts
+
+def session_info(session_dir):
+    """
+    Get the subject and session number for a session directory.
+    """
+
+    session_dir = os.path.normpath(session_dir)
+    name = os.path.basename(session_dir)
+    subject = os.path.basename(os.path.dirname(session_dir))
+    if name.startswith('session_') and name[8:].isdigit():
+        session = int(name[8:])
+    else:
+        session = name
+    return subject, session
+
+def analyze_session(session_dir):
+    """
+    Summarize each set in one session.
+
+    Inputs
+    ------
+    session_dir : str
+        Directory with a math.log file.
+
+    Outputs
+    -------
+    rows : list of tuples
+        One row for each set, with the columns in SET_COLUMNS.
+    """
+
+    subject, session = session_info(session_dir)
+    session_counts = read_session_log(os.path.join(session_dir,
+                                                   'session.log'))
+    sets = {}
+    order = []
+    with open(os.path.join(session_dir, 'math.log')) as f:
+        for line in f:
+            time, event, fields = parse_log_line(line)
+            if not fields:
+                continue
+            try:
+                set_num = int(fields[0])
+            except ValueError:
+                continue
+            if set_num not in sets:
+                sets[set_num] = _SetSummary()
+                order.append(set_num)
+            summary = sets[set_num]
+            
+            if event == 'PROB':
+                if len(fields) < 5 or fields[3] == '':
+                    summary.n_timeout += 1
+                else:
+                    if int(fields[3]):
+                        summary.n_correct += 1
+                    else:
+                        summary.n_incorrect += 1
+                    summary.rts.append(int(fields[4]))
+            elif event == 'MATH START':
+                summary.start = time
+            elif event == 'REST':
+                summary.rest = time
+            elif event == 'MATH END':
+                summary.end = time
+
+    return [sets[i].row(subject, session, i, session_counts)
+            for i in order]
+
+def find_sessions(paths):
+    """
+    Find all session directories with a math.log under some paths.
+    """
+
+    for path in paths:
+        if os.path.isfile(path):
+            yield os.path.dirname(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            if 'math.log' in filenames:
+                yield dirpath
+
+def summarize_subjects(rows):
+    """
+    Combine set summaries into one summary for each subject.
+
+    Inputs
+    ------
+    rows : iterable of tuples
+        Set summaries, with the columns in SET_COLUMNS.
+
+    Outputs
+    -------
+    subjects : list of tuples
+        One row for each subject, with the columns in
+        SUBJECT_COLUMNS.
+    """
+
+    col = dict((name, i) for i, name in enumerate(SET_COLUMNS))
+    totals = {}
+    for row in rows:
+        t = totals.setdefault(row[col['subject']],
+                              {'sessions': set(), 'n_sets': 0,
+                               'n_problems': 0, 'n_correct': 0,
+                               'n_incorrect': 0, 'n_timeout': 0,
+                               'rt_sum': 0., 'medians': [],
+                               'rest': []})
+        t['sessions'].add(row[col['session']])
+        t['n_sets'] += 1
+        for name in ('n_problems', 'n_correct', 'n_incorrect',
+                     'n_timeout'):
+            t[name] += row[col[name]]
+        n_responses = row[col['n_correct']] + row[col['n_incorrect']]
+        if n_responses:
+            t['rt_sum'] += row[col['rt_mean']] * n_responses
+            t['medians'].append(row[col['rt_median']])
+        t['rest'].append(row[col['rest_time']])
+
+    subjects = []
+    for subject in sorted(totals):
+        t = totals[subject]
+        n_responses = t['n_correct'] + t['n_incorrect']
+        accuracy = rt_mean = rt_median = timeout_rate = None
+        if n_responses:
+            accuracy = float(t['n_correct']) / n_responses
+            rt_mean = t['rt_sum'] / n_responses
+            rt_median = sum(t['medians']) / len(t['medians'])
+        if t['n_problems']:
+            timeout_rate = float(t['n_timeout']) / t['n_problems']
+        subjects.append((subject, len(t['sessions']), t['n_sets'],
+                         t['n_problems'], t['n_correct'],
+                         t['n_incorrect'], t['n_timeout'], accuracy,
+                         timeout_rate, rt_mean, rt_median,
+                         float(sum(t['rest'])) / len(t['rest'])))
+    return subjects
+
+def iter_sets(paths, n_workers=None):
+    """
+    Summarize the sets in all sessions under some paths.
+
+    Sessions are analyzed in parallel; rows are generated in the
+    order that sessions are found.
+    """
+
+    sessions = find_sessions(paths)
+    if n_workers == 1:
+        for session_dir in sessions:
+            for row in analyze_session(session_dir):
+                yield row
+        return
+
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for rows in pool.imap(analyze_session, sessions, chunksize=16):
+            for row in rows:
+                yield row
+    finally:
+        pool.close()
+        pool.join()
+
+def _format(value):
+    if isinstance(value, float):
+        return '%.6g' % value
+    elif value is None:
+        return ''
+    return value
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize math distraction logs.")
+    parser.add_argument('paths', nargs='+',
+                        help="data directories or math.log files")
+    parser.add_argument('-o', '--out', default='math_sets.csv',
+                        help="output file for the table of sets")
+    parser.add_argument('-s', '--subjects', default=None,
+                        help="output file for the table of subjects")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    with open(args.out, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(SET_COLUMNS)
+
+        def write_sets():
+            # write each set as it is summarized
+            for row in iter_sets(args.paths, args.workers):
+                writer.writerow([_format(x) for x in row])
+                yield row
+
+        if args.subjects is None:
+            for row in write_sets():
+                pass
+        else:
+            subjects = summarize_subjects(write_sets())
+
+    if args.subjects is not None:
+        with open(args.subjects, 'w') as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(SUBJECT_COLUMNS)
+            for row in subjects:
+                writer.writerow([_format(x) for x in row])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+"""
+Benchmarks for problem generation, evaluation, and presentation.
+
+Times prep_math.gen_problem_set (with each generation method),
+eval_problem, gen_proposed, and prep_math_set at a range of scales
+and numbers of terms, and run_math_set end to end using the headless
+backend. Results are written as JSON, and can be compared against a
+stored baseline to catch regressions.
+
+Example:
+python benchmark.py -o baseline.json
+python benchmark.py -o current.json --compare baseline.json
+"""
+
+import sys
+import json
+import time
+import platform
+import argparse
+import numpy
+import prep_math
+
+# scales (number of problems) to benchmark
+SCALES = (10, 100, 1000, 10000, 100000, 1000000)
+
+# numbers of terms to benchmark
+N_TERMS = (2, 3, 4, 6, 8, 10)
+
+# largest set to generate with the serial method, which is slow
+MAX_SERIAL = 10000
+
+# most precise timer available
+timer = getattr(time, 'perf_counter', time.time)
+
+# minimum total time (s) of each timing, so that fast calls are
+# repeated enough times to be measured reliably
+MIN_TIME = .2
+
+# smallest slowdown (s) that can count as a regression
+MIN_DIFF = .001
+
+def _time_loop(func, number):
+    start = timer()
+    for i in range(number):
+        func()
+    return timer() - start
+
+def autorange(func, min_time=MIN_TIME):
+    """
+    Find how many calls of a function take at least min_time.
+
+    As in timeit.Timer.autorange, the number of calls is increased
+    in steps of 1, 2, 5, 10, 20, 50, ... until the calls take long
+    enough.
+    """
+
+    i = 1
+    while True:
+        for j in (1, 2, 5):
+            number = i * j
+            if _time_loop(func, number) >= min_time:
+                return number
+        i *= 10
+
+def time_call(func, repeat=3, min_time=MIN_TIME):
+    """
+    Time a function call.
+
+    The function is called enough times in each repeat to take at
+    least min_time (see autorange), and times are divided by the
+    number of calls.
+
+    Outputs
+    -------
+    best : float
+        Shortest time (s) per call over repeats.
+    median : float
+        Median time (s) per call over repeats.
+    number : int
+        Number of calls in each repeat.
+    """
+
+    number = autorange(func, min_time)
+    times = [_time_loop(func, number) / number for i in range(repeat)]
+    return min(times), float(numpy.median(times)), number
+
+def _reference():
+    total = 0
+    for i in range(10000):
+        total += i * i
+    numpy.sort(numpy.arange(100000)[::-1])
+    return total
+
+def calibrate(repeat=3):
+    """
+    Time a fixed reference workload.
+
+    Comparisons divide by the ratio of calibration times, so that a
+    machine that is faster or slower overall (e.g. because of CPU
+    frequency scaling or other load) does not look like a change in
+    the code.
+
+    Outputs
+    -------
+    time : float
+        Shortest time (s) per call of the reference workload.
+    """
+    return time_call(_reference, repeat)[0]
+
+def _add(results, name, n, func, repeat):
+    best, median, number = time_call(func, repeat)
+    results[name] = {'n': n, 'best': best, 'median': median,
+                     'number': number, 'per_item': best / n}
+    print('%-50s %12.6f s %12.3f us/item' % (name, best, 1e6 * best / n))
+
+def bench_generation(results, scales, n_terms_list, repeat):
+    """
+    Benchmark gen_problem_set with each method.
+    """
+
+    terms = range(1, 10)
+    ops = ('+', '-')
+    for method in ('serial', 'batch', 'index'):
+        for n_terms in n_terms_list:
+            if method == 'index':
+                # only small problem spaces can be indexed
+                try:
+                    prep_math.load_problem_space(n_terms, terms, ops)
+                except ValueError:
+                    continue
+            for n in scales:
+                if method == 'serial' and n > MAX_SERIAL:
+                    continue
+                name = 'gen_problem_set/%s/terms=%d/n=%d' % (method,
+                                                            n_terms, n)
+                _add(results, name, n,
+                     lambda: prep_math.gen_problem_set(n, n_terms, terms,
+                                                       ops, False, True,
+                                                       method, rng=0),
+                     repeat)
+
+def bench_eval(results, scales, n_terms_list, repeat):
+    """
+    Benchmark eval_problem with a cold and warm cache, and
+    eval_problem_batch.
+    """
+
+    for n_terms in n_terms_list:
+        for n in scales:
+            if n > MAX_SERIAL * 10:
+                continue
+            terms, ops, answers = prep_math.gen_problem_set(
+                n, n_terms, range(1, 10), ('+', '-', '*'), False, False,
+                'batch', rng=0)
+
+            def run():
+                for i in range(n):
+                    prep_math.eval_problem(terms[i], ops[i])
+
+            def cold():
+                prep_math.problem_cache.clear()
+                run()
+
+            _add(results, 'eval_problem/cold/terms=%d/n=%d' % (n_terms, n),
+                 n, cold, repeat)
+            _add(results, 'eval_problem/warm/terms=%d/n=%d' % (n_terms, n),
+                 n, run, repeat)
+
+        for n in scales:
+            t, o = prep_math.gen_problem_batch(n, n_terms, range(1, 10),
+                                               ('+', '-', '*'), rng=0)
+            _add(results, 'eval_problem_batch/terms=%d/n=%d' % (n_terms, n),
+                 n, lambda: prep_math.eval_problem_batch(t, o), repeat)
+
+def bench_proposed(results, scales, repeat):
+    """
+    Benchmark gen_proposed and gen_proposed_batch.
+    """
+
+    dev_vals = [0, 1, -1, 10, -10]
+    dev_probs = [.5, .125, .125, .125, .125]
+    rng = prep_math.get_rng(0)
+    for n in scales:
+        answers = rng.randint(1, 28, n)
+        if n <= MAX_SERIAL:
+            def serial():
+                for x in answers:
+                    prep_math.gen_proposed(x, dev_vals, dev_probs, True, rng)
+            _add(results, 'gen_proposed/n=%d' % n, n, serial, repeat)
+        _add(results, 'gen_proposed_batch/n=%d' % n, n,
+             lambda: prep_math.gen_proposed_batch(answers, dev_vals,
+                                                  dev_probs, True, rng),
+             repeat)
+
+def bench_prep(results, scales, n_terms_list, repeat):
+    """
+    Benchmark prep_math_set with the batch and index methods.
+    """
+
+    for method in ('batch', 'index'):
+        for n_terms in n_terms_list:
+            if method == 'index' and n_terms > 4:
+                continue
+            for n in scales:
+                name = 'prep_math_set/%s/terms=%d/n=%d' % (method,
+                                                          n_terms, n)
+                _add(results, name, n,
+                     lambda: prep_math.prep_math_set(numVars=n_terms,
+                         maxProbs=n, plusAndMinus=True, tfProblems=True,
+                         genMethod=method, seed=0),
+                     repeat)
+
+def bench_presentation(results, n_sets_list, repeat):
+    """
+    Benchmark run_math_set end to end on the headless backend.
+    """
+
+    try:
+        import math_distract
+        import headless
+    except ImportError as err:
+        print('Skipping presentation benchmarks: %s' % err)
+        return
+
+    for n_sets in n_sets_list:
+        problems = prep_math.prep_problem_sets(n_sets, 0, numVars=3,
+                                               maxProbs=20,
+                                               tfProblems=True,
+                                               genMethod='batch')
+        counts = []
+
+        def run():
+            responder = headless.SimulatedResponder(['N', 'M'], rt=800,
+                                                    seed=0)
+            backend = headless.HeadlessBackend(responder, seed=0)
+            mathlog = backend.LogTrack('math')
+            tf_bc = backend.ButtonChooser('N', 'M')
+            n_problems = 0
+            for i in range(n_sets):
+                out = math_distract.run_math_set(problems[i],
+                    clock=backend.clock, mathlog=mathlog,
+                    minProblemTime=400, textSize=.1,
+                    maxDistracterLimit=7500, trialNum=i, tf_bc=tf_bc,
+                    tfKeys=['N', 'M'], presentSeq=True,
+                    numberDuration=500, probISI=200, probJitter=200,
+                    backend=backend)
+                n_problems += out[1]
+            counts.append(n_problems)
+
+        best, median, number = time_call(run, repeat)
+        n_problems = counts[-1]
+        name = 'run_math_set/headless/sets=%d' % n_sets
+        results[name] = {'n': n_problems, 'best': best, 'median': median,
+                         'number': number, 'per_item': best / n_problems,
+                         'sets_per_s': n_sets / best}
+        print('%-50s %12.6f s %12.3f us/trial' %
+              (name, best, 1e6 * best / n_problems))
+
+def compare(results, baseline, threshold=1.25, min_diff=MIN_DIFF,
+            speed=1.):
+    """
+    Compare results to a baseline.
+
+    Inputs
+    ------
+    results : dict
+        Benchmark results.
+    baseline : dict
+        Baseline results, in the same format.
+    threshold : float
+        Ratio of current to baseline time above which a benchmark is
+        considered a regression.
+    min_diff : float
+        Minimum increase (s) in time for a benchmark to be considered
+        a regression, so that noise in very fast benchmarks is not
+        flagged.
+    speed : float
+        Ratio of current to baseline calibration time (see
+        calibrate). Baseline times are scaled by this ratio before
+        comparing.
+
+    Outputs
+    -------
+    regressions : list of (name, ratio)
+    """
+
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        expected = baseline[name]['best'] * speed
+        ratio = results[name]['best'] / expected
+        diff = results[name]['best'] - expected
+        flag = ''
+        if ratio > threshold and diff > min_diff:
+            flag = '  REGRESSION'
+            regressions.append((name, ratio))
+        print('%-50s %8.2fx%s' % (name, ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark math problem generation and presentation.")
+    parser.add_argument('-o', '--out', default=None,
+                        help="file to write results to (JSON)")
+    parser.add_argument('-c', '--compare', default=None,
+                        help="baseline results to compare to (JSON)")
+    parser.add_argument('-t', '--threshold', type=float, default=1.25,
+                        help="slowdown ratio that counts as a regression")
+    parser.add_argument('-f', '--floor', type=float, default=MIN_DIFF,
+                        help="slowdown (s) below which a benchmark never "
+                        "counts as a regression")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="number of times to repeat each benchmark")
+    parser.add_argument('-q', '--quick', action='store_true',
+                        help="only run small scales")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        scales = SCALES[:4]
+        n_terms_list = N_TERMS[:3]
+        n_sets_list = (10,)
+    else:
+        scales = SCALES
+        n_terms_list = N_TERMS
+        n_sets_list = (10, 100, 1000)
+
+    # calibrate before and after, in case the speed of the machine
+    # changes during the run
+    calibration = calibrate(args.repeat)
+    results = {}
+    bench_generation(results, scales, n_terms_list, args.repeat)
+    bench_eval(results, scales, n_terms_list, args.repeat)
+    bench_proposed(results, scales, args.repeat)
+    bench_prep(results, scales, n_terms_list, args.repeat)
+    bench_presentation(results, n_sets_list, args.repeat)
+    calibration = (calibration + calibrate(args.repeat)) / 2
+
+    output = {'meta': {'python': platform.python_version(),
+                       'numpy': numpy.__version__,
+                       'platform': platform.platform(),
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'repeat': args.repeat,
+                       'calibration': calibration},
+              'results': results}
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        speed = 1.
+        if 'calibration' in baseline['meta']:
+            speed = calibration / baseline['meta']['calibration']
+            print('machine speed relative to baseline: %.2fx' %
+                  (1 / speed))
+        regressions = compare(results, baseline['results'],
+                              args.threshold, args.floor, speed)
+        if regressions:
+            print('%d benchmarks regressed' % len(regressions))
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
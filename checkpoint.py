@@ -0,0 +1,229 @@
+"""
+Append-only checkpoints for distract_pres sessions.
+
+The problem bank for a session is written once, when the session is
+prepared. After that, progress is saved by appending a small,
+fixed-size record at the end of each set and syncing it to disk, so
+the cost of a checkpoint does not depend on the size of the bank.
+When a session is resumed, the records are replayed to find where
+it left off. A partial record at the end of the file (e.g. if the
+session crashed while it was being written) is discarded.
+
+Record fields
+-------------
+setNum : int32
+    Number of the set that was completed.
+nCorrect : int32
+    Number of problems answered correctly.
+nProblems : int32
+    Number of problems presented.
+startTime : int64
+    Time (ms) that the set started.
+"""
+
+import os
+import struct
+import numpy
+import prep_math
+
+# files in the session directory
+BANK_FILE = 'problems.bin'
+PROGRESS_FILE = 'progress.bin'
+
+RECORD_DTYPE = numpy.dtype([('setNum', '<i4'), ('nCorrect', '<i4'),
+                            ('nProblems', '<i4'), ('startTime', '<i8')])
+
+_record = struct.Struct('<iiiq')
+
+# magic, version, record size
+_header = struct.Struct('<4sHH')
+_magic = b'MDCK'
+_version = 1
+
+def write_bank(filename, problems):
+    """
+    Write a problem bank.
+
+    The bank is written to a temporary file and synced before it is
+    moved into place, so a crash never leaves a partial bank.
+
+    Inputs
+    ------
+    filename : str
+    problems : prep_math.ProblemSet
+    """
+
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(problems.to_bytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+def read_bank(filename):
+    """
+    Read a problem bank written by write_bank.
+
+    Outputs
+    -------
+    problems : prep_math.ProblemSet
+    """
+
+    with open(filename, 'rb') as f:
+        return prep_math.ProblemSet.from_bytes(f.read())
+
+def _check_header(filename, data):
+    """
+    Check the header of a progress file.
+    """
+    if len(data) < _header.size:
+        raise ValueError("%s is not a progress file." % filename)
+    magic, version, size = _header.unpack(data[:_header.size])
+    if magic != _magic:
+        raise ValueError("%s is not a progress file." % filename)
+    if version != _version or size != _record.size:
+        raise ValueError("%s has an unsupported format version." %
+                         filename)
+
+class ProgressLog(object):
+    """
+    Writer for progress records.
+
+    Inputs
+    ------
+    filename : str
+        File to write to. If it exists, records are appended after
+        the last complete record.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                _check_header(filename, f.read(_header.size))
+            # drop any partial record left by a crash, so that new
+            # records stay aligned
+            size = os.path.getsize(filename)
+            n_records = (size - _header.size) // _record.size
+            valid = _header.size + n_records * _record.size
+            self._file = open(filename, 'r+b')
+            if valid < size:
+                self._file.truncate(valid)
+            self._file.seek(valid)
+        else:
+            self._file = open(filename, 'wb')
+            self._file.write(_header.pack(_magic, _version, _record.size))
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def append(self, setNum, nCorrect, nProblems, startTime):
+        """
+        Record a completed set and sync it to disk.
+
+        Inputs
+        ------
+        setNum : int
+        nCorrect : int
+        nProblems : int
+        startTime : int or (int, int)
+            Start time of the set, optionally with its maximum
+            latency (which is not saved).
+        """
+        if isinstance(startTime, tuple):
+            startTime = startTime[0]
+        self._file.write(_record.pack(setNum, nCorrect, nProblems,
+                                      startTime))
+        self._sync()
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+def read_progress(filename):
+    """
+    Load progress records.
+
+    Outputs
+    -------
+    records : numpy.ndarray
+        Structured array with dtype RECORD_DTYPE. Empty if the file
+        does not exist.
+    """
+
+    if not os.path.exists(filename):
+        return numpy.zeros(0, dtype=RECORD_DTYPE)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    _check_header(filename, data)
+    n_records = (len(data) - _header.size) // RECORD_DTYPE.itemsize
+    return numpy.frombuffer(data, dtype=RECORD_DTYPE, count=n_records,
+                            offset=_header.size)
+
+def replay(records):
+    """
+    Find where a session left off.
+
+    Inputs
+    ------
+    records : numpy.ndarray
+        Progress records (see read_progress).
+
+    Outputs
+    -------
+    setNum : int
+        Number of the next set to run.
+    tcorrect : int
+        Total number of problems answered correctly so far.
+    """
+
+    # if a set was recorded more than once, use the last record
+    correct = {}
+    setNum = 0
+    for rec in records:
+        correct[int(rec['setNum'])] = int(rec['nCorrect'])
+        setNum = int(rec['setNum']) + 1
+    return setNum, sum(correct.values())
+
+class CheckpointStore(object):
+    """
+    Problem bank and progress records for one session.
+
+    Inputs
+    ------
+    directory : str
+        Session directory to keep the files in.
+    """
+
+    def __init__(self, directory):
+        self.bank_file = os.path.join(directory, BANK_FILE)
+        self.progress_file = os.path.join(directory, PROGRESS_FILE)
+        self._log = None
+
+    def save_bank(self, problems):
+        """Write the problem bank, and clear any progress."""
+        write_bank(self.bank_file, problems)
+        if os.path.exists(self.progress_file):
+            os.remove(self.progress_file)
+
+    def load_bank(self):
+        """Read the problem bank."""
+        return read_bank(self.bank_file)
+
+    def resume(self):
+        """Get the next set number and total correct so far."""
+        return replay(read_progress(self.progress_file))
+
+    def append(self, setNum, nCorrect, nProblems, startTime):
+        """Record a completed set (see ProgressLog.append)."""
+        if self._log is None:
+            self._log = ProgressLog(self.progress_file)
+        self._log.append(setNum, nCorrect, nProblems, startTime)
+
+    def close(self):
+        """Close the progress file."""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
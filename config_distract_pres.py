@@ -1,16 +1,53 @@
 
 # math problem options
 numSets = 10
+# seed for generating problems; if None, a new seed is drawn for
+# each session
+randomSeed = None
 numVars = 3
 minNum = 1
 maxNum = 9
-maxProbs = 10
+# number of problems to prepare for each set; if None, prepares the
+# most problems that could fit in a distraction period, given the
+# presentation options below and minResponseTime
+maxProbs = None
 plusAndMinus = False
 ansMod = [0,1,-1,2,-1]
 ansProb = [.5,.125,.125,.125,.125]
+# if False, the answer is typed and committed with ENTER/RETURN
 tfProblems = True
 uniqueVars = True
 excludeRepeats = True
+# constraints on problem difficulty: range of allowed answers (None
+# for no limit), no negative intermediate results, no carrying or
+# borrowing, and minimum difference between the answers of
+# consecutive problems (None for no minimum)
+minAnswer = None
+maxAnswer = None
+nonNegative = False
+noCarry = False
+minAnswerDiff = None
+# don't reuse problems ('problem'), or pairings of problems and
+# proposed answers ('pair'); None to allow reuse
+uniqueProblems = None
+# keep problems unique within each 'session', or across all of a
+# 'subject''s sessions
+uniqueScope = 'session'
+# 'serial' (the original generator), or opt in to 'batch' (faster
+# for large problem banks) or 'index' (samples from an index of every
+# possible problem; fastest for small problem spaces)
+genMethod = 'serial'
+# directory for caching problem space indexes between sessions; None
+# to keep them in memory only. Set a directory (e.g. 'cache') to
+# reuse indexes with genMethod = 'index'
+cacheDir = None
+# when to prepare problem sets: 'session' (all sets, before the
+# session starts) or 'ahead' (each set during the set before it)
+prepMode = 'session'
+# directory of problems prepared by prep_sessions.py to load for each
+# session, instead of generating them (None to generate). Use the
+# data directory, so that the registry of used problems is shared
+preparedDir = None
 
 # text
 defaultFont = 'fonts/Verdana.ttf'
@@ -41,6 +78,31 @@ probISI = 200
 probJitter = 200
 setISI = 2000
 setJitter = 0
+# fastest response (ms) assumed when planning the number of problems.
+# Sets only never run out if no response is faster than this; with 0,
+# the number of problems is still limited by probISI
+minResponseTime = 0
+# if True, present problems against absolute deadlines, with the
+# jitter for each set drawn up front, so that delays in drawing or
+# logging do not add up over the period
+deadlineSchedule = False
 
 # responses
 tfKeys = ['N','M']
+# problems to give a feedback beep for: 'incorrect', 'correct',
+# 'both', or 'none'
+feedback = 'incorrect'
+
+# logging
+# log the time taken to prepare each problem during the ISI
+logPrep = False
+# when to write the math log: None (immediately), 'set' (at the end
+# of each set), or 'thread' (from a background thread)
+logMode = None
+# record stimulus timing and flag sets where any onset was off by
+# more than this many ms (None to disable). Onsets wait for the next
+# screen refresh, so use at least one frame (about 17 ms at 60 Hz)
+timingTolerance = None
+# also write a binary math log (math.bin) that can be loaded with
+# math_binlog.read_binary_log
+binaryLog = False
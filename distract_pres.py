@@ -1,67 +1,180 @@
 #!/usr/bin/python
 
-from pyepl.locals import *
-
-# other modules
+# PyEPL is imported when presentation starts, so that sessions can be
+# prepared or simulated (see headless.py) without it
 import os
-import sys
-import shutil
 import math_distract as math
 import prep_math as prep
+import math_binlog
+import checkpoint
+import prep_sessions
 
 def prepare(exp, config):
     """
     Prepare a number of problem sets.
+
+    If config.prepMode is 'ahead', only the seed is saved, and each
+    set is prepared during the set before it (see run). If
+    config.preparedDir is set, problems prepared by prep_sessions.py
+    for the session are loaded instead of being generated.
     """
     
     # get the state
     state = exp.restoreState()
+
+    # options added since the original config; older configs without
+    # them run as before
+    randomSeed = getattr(config, 'randomSeed', None)
+    prepMode = getattr(config, 'prepMode', 'session')
+    preparedDir = getattr(config, 'preparedDir', None)
+    uniqueProblems = getattr(config, 'uniqueProblems', None)
+    uniqueScope = getattr(config, 'uniqueScope', 'session')
     
+    # get a seed for the session; saving it allows any set to be
+    # regenerated later
+    if randomSeed is None:
+        seed = prep.random_seed()
+    else:
+        seed = randomSeed
+
+    if prepMode == 'ahead':
+        if uniqueProblems is not None and uniqueScope == 'subject':
+            raise ValueError("Problems can only be kept unique across "
+                             "sessions if prepMode is 'session'.")
+        if preparedDir is not None:
+            raise ValueError("Prepared problems can only be loaded if "
+                             "prepMode is 'session'.")
+        exp.saveState(state, seed=seed, setNum=0, tcorrect=0)
+        return
+    elif prepMode != 'session':
+        raise ValueError("Unknown prepMode: %r" % (prepMode,))
+
+    store = checkpoint.CheckpointStore(exp.session.fullPath())
+    if preparedDir is not None:
+        # use the problems prepared for this session
+        filename = prep_sessions.prepared_file(preparedDir,
+                                               exp.session.fullPath())
+        if not os.path.exists(filename):
+            raise ValueError("No prepared problems for this session: %s" %
+                             filename)
+        with open(filename, 'rb') as f:
+            problems = prep.ProblemSet.from_bytes(f.read())
+        if len(problems) < config.numSets:
+            raise ValueError("%s has %d sets, but numSets is %d." %
+                             (filename, len(problems), config.numSets))
+        if config.tfProblems and problems.proposed is None:
+            raise ValueError("%s has no proposed answers." % filename)
+        store.save_bank(problems)
+        exp.saveState(state, seed=seed, setNum=0, tcorrect=0)
+        return
+
+    # keep problems from being reused within the session, or across
+    # all of the subject's sessions
+    registry = prep.make_registry(uniqueProblems)
+    registry_file = None
+    if registry is not None and uniqueScope == 'subject':
+        registry_file = os.path.join(
+            os.path.dirname(exp.session.fullPath()),
+            prep_sessions.REGISTRY_FILE)
+        if os.path.exists(registry_file):
+            registry = prep.ProblemRegistry.load(registry_file)
+
     # create a number of problem sets
-    terms = []
-    ops = []
-    answers = []
-    proposed = []
-    for i in range(config.numSets):
-        set_config = prep.prep_math_set(config.numVars,
-            config.minNum, config.maxNum, config.maxProbs, 
-            config.plusAndMinus, config.ansMod, config.ansProb,
-            config.tfProblems, config.uniqueVars, 
-            config.excludeRepeats)
-        terms.append(set_config[0])
-        ops.append(set_config[1])
-        answers.append(set_config[2])
-        proposed.append(set_config[3])
+    problems = prep.prep_problem_sets(config.numSets, seed,
+                                      registry=registry,
+                                      **prep.set_options(config))
+    if registry_file is not None:
+        registry.save(registry_file)
+
+    # write the problems once; progress through the session is saved
+    # separately after each set
+    store.save_bank(problems)
 
     # save the prepared data
-    exp.saveState(state, terms=terms, ops=ops, answers=answers,
-                  proposed=proposed, setNum=0, tcorrect=0)
+    exp.saveState(state, seed=seed, setNum=0, tcorrect=0)
 
-def run(exp, config):    
+def run(exp, config, backend=None):
     """
     Run some math distraction periods.
+
+    By default, presentation uses PyEPL. Another backend with the
+    interface of math_distract.PyEPLBackend may be given instead
+    (see headless.py).
     """
     
-    # get the state
+    # options added since the original config; older configs without
+    # them run as before
+    prepMode = getattr(config, 'prepMode', 'session')
+    uniqueProblems = getattr(config, 'uniqueProblems', None)
+    binaryLog = getattr(config, 'binaryLog', False)
+    timingTolerance = getattr(config, 'timingTolerance', None)
+    deadlineSchedule = getattr(config, 'deadlineSchedule', False)
+    logPrep = getattr(config, 'logPrep', False)
+    logMode = getattr(config, 'logMode', None)
+    feedback = getattr(config, 'feedback', 'incorrect')
+
+    # get the state, and replay progress saved after each set
     state = exp.restoreState()
+    store = checkpoint.CheckpointStore(exp.session.fullPath())
+    if prepMode == 'session':
+        problems = store.load_bank()
+    state.setNum, state.tcorrect = store.resume()
 
     # create tracks
-    video = VideoTrack("video")
-    audio = AudioTrack("audio")
-    keyboard = KeyTrack("keyboard")
-    log = LogTrack("session")
-    mathlog = LogTrack("math")
-    clock = PresentationClock()
+    usePyEPL = backend is None
+    if usePyEPL:
+        from pyepl.locals import (VideoTrack, AudioTrack, KeyTrack,
+                                  Font, Text, setDefaultFont,
+                                  waitForAnyKey)
+        VideoTrack("video")
+        AudioTrack("audio")
+        KeyTrack("keyboard")
+        backend = math.PyEPLBackend()
+    video = backend.video
+    log = backend.LogTrack("session")
+    mathlog = backend.LogTrack("math")
+    if binaryLog:
+        binlog = math_binlog.BinaryMathLog(
+            os.path.join(exp.session.fullPath(), 'math.bin'))
+    else:
+        binlog = None
+    clock = backend.Clock()
+    if timingTolerance is not None:
+        timing = math.TimingRecorder(timingTolerance)
+    else:
+        timing = None
 
     # prep buttons
     tfkeys = config.tfKeys
-    tf_bc = ButtonChooser(Key(tfkeys[0]), Key(tfkeys[1]))
+    if config.tfProblems:
+        tf_bc = backend.ButtonChooser(tfkeys[0], tfkeys[1])
+    else:
+        # answers are typed
+        tf_bc = None
     
     # prep displays
-    fix = Text('+', size=config.fixHeight)
+    fix = backend.text_cache.get('+', config.fixHeight)
 
-    # set the font
-    setDefaultFont(Font(config.defaultFont))
+    # set the font; text rendered with the old default font is
+    # no longer valid
+    if usePyEPL:
+        setDefaultFont(Font(config.defaultFont))
+    backend.text_cache.clear()
+    setFix = backend.text_cache.get('*', config.textSize)
+
+    if prepMode == 'ahead':
+        # prepare each set, and render its text, on a background
+        # thread while the set before it finishes
+        def render(problems):
+            for terms, ops, answer, proposed in problems.iter_problems():
+                math.prepare_problem(terms, ops, answer, config.textSize,
+                                     config.tfProblems, tfkeys, proposed,
+                                     config.presentSeq, config.showEquals,
+                                     backend.text_cache)
+        options = prep.set_options(config)
+        options['registry'] = prep.make_registry(uniqueProblems)
+        preparer = math.SetPreparer(state.seed, options, render)
+        preparer.start(state.setNum)
 
     # prepare the screen
     video.clear("black")
@@ -70,13 +183,18 @@ def run(exp, config):
     while state.setNum < config.numSets:
         # run set
         i = state.setNum
-        if not state.proposed is None:
-            set_proposed = state.proposed[i]
+        if prepMode == 'ahead':
+            current = preparer.get(i)
+        else:
+            current = problems[i]
+        if deadlineSchedule:
+            # jitter for each set comes from its own stream of the
+            # session seed, so it is the same if the session resumes
+            schedule = math.DeadlineSchedule(
+                prep.child_seed(prep.child_seed(state.seed, i), 2))
         else:
-            set_proposed = None
-        out = math.run_math_set(state.terms[i], state.ops[i], 
-                                state.answers[i],
-                                set_proposed, clock = clock, 
+            schedule = None
+        out = math.run_math_set(current, clock = clock, 
                                 mathlog = mathlog,
                                 minProblemTime = config.minProblemTime,
                                 textSize = config.textSize,
@@ -90,34 +208,64 @@ def run(exp, config):
                                 showEquals = config.showEquals,
                                 numberISI = config.numberISI,
                                 probISI = config.probISI,
-                                probJitter = config.probJitter)
+                                probJitter = config.probJitter,
+                                logPrep = logPrep,
+                                logMode = logMode,
+                                binlog = binlog,
+                                backend = backend,
+                                timing = timing,
+                                schedule = schedule,
+                                feedback = feedback)
         (nCorrect, nProblems, startTime, probTimes, fixDisp) = out
 
+        # the last problem has been presented; prepare the next set
+        # during the rest of the period and the ISI between sets
+        if prepMode == 'ahead' and i + 1 < config.numSets:
+            preparer.start(i + 1)
+
         # log the problem set
         log.logMessage('%s\t%d\t%d\t%d' % 
                        ('DISTRACTOR', state.setNum, nProblems, nCorrect),
                         startTime)
 
+        # flag sets where presentation timing was off
+        if timing is not None:
+            t = timing.summary()
+            if t['drifted']:
+                log.logMessage('%s\t%d\t%d\t%d' %
+                               ('TIMING_DRIFT', state.setNum,
+                                t['max_error'], t['n_late']), startTime)
+                print('Warning: stimulus timing in set %d was off by up '
+                      'to %d ms' % (state.setNum, t['max_error']))
+
         # ISI between sets
         if fixDisp is not None:
-            stim = video.replace(fixDisp, Text('*', size=config.textSize))
+            stim = video.replace(fixDisp, setFix)
         else:
-            stim = video.showCentered(Text('*', size=config.textSize))
+            stim = video.showCentered(setFix)
         ts = video.updateScreen(clock)
         clock.delay(config.setISI, config.setJitter)
         video.unshow(stim)
         log.logMessage('%s\t%d\t\t' % ('FIX', state.setNum), ts)
 
         # move to the next set
+        store.append(state.setNum, nCorrect, nProblems, startTime)
+        state.tcorrect += nCorrect
         state.setNum += 1
-        exp.saveState(state)
+
+    store.close()
+    if binlog is not None:
+        binlog.close()
 
     # update the screen
     video.updateScreen(clock)
     
     # done
-    timestamp = waitForAnyKey(clock,Text(
-        "Thank you!\nYou have completed the session."))
+    if usePyEPL:
+        timestamp = waitForAnyKey(clock,Text(
+            "Thank you!\nYou have completed the session."))
+    else:
+        timestamp = clock.get()
     log.logMessage('SESS_END', timestamp)
     
     # catch up
@@ -128,6 +276,7 @@ def run(exp, config):
 if __name__ == "__main__":
     
     # start PyEPL
+    from pyepl.locals import Experiment
     exp = Experiment()
     exp.parseArgs()
     exp.setup()
@@ -138,10 +287,10 @@ if __name__ == "__main__":
     
     # get subject configuration
     config = exp.getConfig()
-	
+    
     # if there was no saved state, run the prepare function
     if not exp.restoreState():
-	prepare(exp, config)
-	    
+        prepare(exp, config)
+        
     # run the experiment
     run(exp, config)
@@ -0,0 +1,573 @@
+"""
+Headless backend for running math distraction periods without a
+display.
+
+The video, audio, and keyboard tracks and the clock are replaced by
+stand-ins that advance virtual time instead of waiting, and responses
+are made by a simulated participant. run_math_set and
+distract_pres.run then execute the same code as in an experiment, as
+fast as the code itself runs. This is useful for testing, for
+benchmarking, and for checking how a design will play out (e.g. how
+many problems fit in a distraction period).
+
+Example:
+responder = SimulatedResponder(['N', 'M'], rt=lognormal_rt(1200, .3),
+                               p_timeout=.05, seed=1)
+backend = HeadlessBackend(responder, seed=2)
+math_distract.run_math_set(problems, clock=backend.clock,
+                           tf_bc=backend.ButtonChooser('N', 'M'),
+                           tfKeys=['N', 'M'], backend=backend)
+
+For typed answers, use a SimulatedTypist (created by default if no
+responder is given), which reads each problem from the screen and
+types its answer.
+"""
+
+import tempfile
+import numpy
+import prep_math
+import math_distract
+
+class VirtualClock(object):
+    """
+    Presentation clock that runs on virtual time.
+
+    Inputs
+    ------
+    start : int
+        Starting time (ms).
+    seed : seed or numpy.random.RandomState
+        Source of random jitter (see prep_math.get_rng).
+    """
+
+    def __init__(self, start=0, seed=None):
+        self.time = start
+        self.rng = prep_math.get_rng(seed)
+
+    def get(self):
+        """Get the current time."""
+        return self.time
+
+    def delay(self, howlong=0, jitter=0):
+        """Advance time, with up to jitter ms of random jitter."""
+        if jitter:
+            howlong += int(self.rng.randint(0, jitter + 1))
+        self.time += int(howlong)
+
+    def tare(self, timestamp):
+        """Set the current time."""
+        if isinstance(timestamp, tuple):
+            timestamp = timestamp[0]
+        self.time = timestamp
+
+    def wait(self):
+        """Wait for the clock to catch up (returns immediately)."""
+        pass
+
+class VirtualText(object):
+    """
+    Text that is never rendered.
+    """
+
+    def __init__(self, text, font=None, size=None):
+        self.text = text
+        self.font = font
+        self.size = size
+
+    def __repr__(self):
+        return 'VirtualText(%r)' % (self.text,)
+
+class VirtualBeep(object):
+    """
+    Beep that is never synthesized.
+    """
+
+    def __init__(self, freq, duration, rampDuration):
+        self.freq = freq
+        self.duration = duration
+        self.rampDuration = rampDuration
+
+class VirtualKey(object):
+    """
+    Key returned by simulated responses.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+class _Shown(object):
+    """
+    Handle for a showable on the virtual screen.
+    """
+
+    def __init__(self, showable):
+        self.showable = showable
+
+class VirtualVideoTrack(object):
+    """
+    Video track that keeps track of what would be on the screen.
+
+    Everything that is shown is also added to history, with the time
+    it was shown, so that a simulated participant can read the
+    problems that were presented.
+
+    Inputs
+    ------
+    clock : VirtualClock
+        Default clock for screen updates.
+    latency : int
+        Maximum latency (ms) reported for each screen update.
+    """
+
+    def __init__(self, clock, latency=0):
+        self.clock = clock
+        self.latency = latency
+        self.shown = []
+        self.history = []
+        self.nUpdates = 0
+
+    def _show(self, showable):
+        handle = _Shown(showable)
+        self.shown.append(handle)
+        self.history.append((self.clock.get(), showable))
+        return handle
+
+    def showCentered(self, showable):
+        return self._show(showable)
+
+    def showProportional(self, showable, x, y):
+        return self._show(showable)
+
+    def showRelative(self, showable, relation, relative):
+        return self._show(showable)
+
+    def replace(self, old, new):
+        self.unshow(old)
+        return self._show(new)
+
+    def unshow(self, *handles):
+        for handle in handles:
+            if handle in self.shown:
+                self.shown.remove(handle)
+
+    def clear(self, color=None):
+        self.shown = []
+
+    def updateScreen(self, clock=None):
+        """
+        Update the screen; returns the time of the update.
+        """
+        if clock is None:
+            clock = self.clock
+        self.nUpdates += 1
+        return (clock.get(), self.latency)
+
+class VirtualAudioTrack(object):
+    """
+    Audio track that records what would have been played.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.played = []
+
+    def play(self, sound, t=None, doDelay=True):
+        if t is None:
+            t = self.clock
+        timestamp = (t.get(), 0)
+        self.played.append((sound, timestamp))
+        if doDelay:
+            t.delay(sound.duration)
+        return timestamp
+
+class VirtualLogTrack(object):
+    """
+    Log that keeps (timestamp, message) records in memory.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.records = []
+
+    def logMessage(self, message, timestamp=None):
+        self.records.append((timestamp, message))
+
+def lognormal_rt(median, sigma):
+    """
+    Reaction times drawn from a lognormal distribution.
+
+    Inputs
+    ------
+    median : float
+        Median reaction time (ms).
+    sigma : float
+        Standard deviation of log reaction time.
+    """
+    def draw(rng):
+        return median * numpy.exp(sigma * rng.standard_normal())
+    return draw
+
+def ex_gaussian_rt(mu, sigma, tau):
+    """
+    Reaction times drawn from an ex-Gaussian distribution.
+
+    Inputs
+    ------
+    mu, sigma : float
+        Mean and standard deviation (ms) of the Gaussian component.
+    tau : float
+        Mean (ms) of the exponential component.
+    """
+    def draw(rng):
+        return rng.normal(mu, sigma) + rng.exponential(tau)
+    return draw
+
+class SimulatedResponder(object):
+    """
+    Simulated participant that presses one of several keys.
+
+    Can be used in place of a PyEPL ButtonChooser (or a key
+    chooser).
+
+    Inputs
+    ------
+    keys : list of strs
+        Names of keys that may be pressed.
+    rt : number or callable
+        Reaction time (ms). If callable, it is called with a
+        numpy.random.RandomState to draw each reaction time (see
+        lognormal_rt and ex_gaussian_rt).
+    p_timeout : float
+        Probability of not responding at all on a trial.
+    p_keys : list of floats
+        Probability of pressing each key. Default is to press each
+        key equally often.
+    seed : seed or numpy.random.RandomState
+        Source of random numbers (see prep_math.get_rng).
+    """
+
+    def __init__(self, keys, rt=1000, p_timeout=0., p_keys=None,
+                 seed=None):
+        self.keys = list(keys)
+        self.rt = rt
+        self.p_timeout = p_timeout
+        self.p_keys = p_keys
+        self.rng = prep_math.get_rng(seed)
+        self.nResponses = 0
+        self.nTimeouts = 0
+
+    def _draw_rt(self):
+        if callable(self.rt):
+            rt = self.rt(self.rng)
+        else:
+            rt = self.rt
+        return max(int(round(rt)), 0)
+
+    def waitWithTime(self, maxDuration=None, clock=None, **kwargs):
+        """
+        Wait for a simulated key press.
+
+        Outputs
+        -------
+        key : VirtualKey
+            Key that was pressed, or None if there was no response
+            within maxDuration.
+        timestamp : (int, int)
+            Time of the response (or of the timeout).
+        """
+
+        timeout = (self.p_timeout > 0 and
+                   self.rng.random_sample() < self.p_timeout)
+        rt = self._draw_rt()
+        if timeout or (maxDuration is not None and rt >= maxDuration):
+            if maxDuration is None:
+                raise ValueError('Cannot time out without a maxDuration.')
+            clock.delay(maxDuration)
+            self.nTimeouts += 1
+            return None, (clock.get(), 0)
+
+        clock.delay(rt)
+        ind = self.rng.choice(len(self.keys), p=self.p_keys)
+        self.nResponses += 1
+        return VirtualKey(self.keys[ind]), (clock.get(), 0)
+
+def _read_problem(texts):
+    """
+    Work out the answer to the last problem in a list of texts shown
+    on the screen, as a participant would.
+
+    If a whole problem (e.g. '3 + 4') was shown, it is solved.
+    Otherwise, the terms were presented one at a time without their
+    operators, so the last run of numbers before the answer field
+    (e.g. '?') is added.
+    """
+
+    for text in reversed(texts):
+        tokens = text.split(' ')
+        if len(tokens) > 1:
+            terms = [int(x) for x in tokens[::2]]
+            return prep_math.eval_problem(terms, tokens[1::2])[0]
+
+    terms = []
+    run = []
+    for text in texts:
+        if text.lstrip('-').isdigit():
+            run.append(int(text))
+        elif run:
+            terms = run
+            run = []
+    return sum(terms)
+
+class SimulatedTypist(object):
+    """
+    Simulated participant that types answers and presses RETURN.
+
+    Can be used in place of a PyEPL key chooser. The typist reads
+    each problem from the video track, and types the correct answer
+    (or, on error trials, a nearby wrong answer) one digit at a time.
+
+    Inputs
+    ------
+    video : VirtualVideoTrack
+        Screen to read problems from. If None, it is set by the
+        HeadlessBackend that the typist is given to.
+    rt : number or callable
+        Time (ms) from the problem to the first key. If callable, it
+        is called with a numpy.random.RandomState to draw each time
+        (see lognormal_rt and ex_gaussian_rt).
+    keyRT : number or callable
+        Time (ms) between keys.
+    p_error : float
+        Probability of typing a wrong answer.
+    errors : list of ints
+        Possible differences between a wrong answer and the correct
+        answer.
+    p_timeout : float
+        Probability of not responding at all on a trial.
+    seed : seed or numpy.random.RandomState
+        Source of random numbers (see prep_math.get_rng).
+    """
+
+    def __init__(self, video=None, rt=1500, keyRT=150, p_error=0.,
+                 errors=(-2, -1, 1, 2), p_timeout=0., seed=None):
+        self.video = video
+        self.rt = rt
+        self.keyRT = keyRT
+        self.p_error = p_error
+        self.errors = list(errors)
+        self.p_timeout = p_timeout
+        self.rng = prep_math.get_rng(seed)
+        self.nResponses = 0
+        self.nTimeouts = 0
+        self._keys = None
+        self._read = 0
+        self._time = None
+
+    def _draw(self, rt):
+        if callable(rt):
+            rt = rt(self.rng)
+        return max(int(round(rt)), 0)
+
+    def _start(self):
+        """
+        Read the current problem and plan the keys for its answer.
+        """
+
+        texts = [x.text for t, x in self.video.history[self._read:]]
+        self._read = len(self.video.history)
+        answer = int(round(_read_problem(texts)))
+        if self.p_error > 0 and self.rng.random_sample() < self.p_error:
+            answer += self.errors[self.rng.randint(0, len(self.errors))]
+        if (self.p_timeout > 0 and
+            self.rng.random_sample() < self.p_timeout):
+            return []
+        keys = list(str(answer)) + ['RETURN']
+        delays = [self._draw(self.rt)]
+        delays += [self._draw(self.keyRT) for x in keys[1:]]
+        return list(zip(keys, delays))
+
+    def waitWithTime(self, maxDuration=None, clock=None, **kwargs):
+        """
+        Wait for the next simulated key press.
+
+        Outputs
+        -------
+        key : VirtualKey
+            Key that was pressed, or None if there was no key within
+            maxDuration.
+        timestamp : (int, int)
+            Time of the key (or of the timeout).
+        """
+
+        if self._keys is not None and clock.get() != self._time:
+            # time has passed since the last key, so the entry was
+            # cut off (e.g. at the end of the period); skip anything
+            # shown in response to that key
+            history = self.video.history
+            while (self._read < len(history) and
+                   history[self._read][0] <= self._time):
+                self._read += 1
+            self._keys = None
+        if self._keys is None:
+            self._keys = self._start()
+        if not self._keys or (maxDuration is not None and
+                              self._keys[0][1] >= maxDuration):
+            if maxDuration is None:
+                raise ValueError('Cannot time out without a maxDuration.')
+            clock.delay(maxDuration)
+            self.nTimeouts += 1
+            self._keys = None
+            return None, (clock.get(), 0)
+
+        name, delay = self._keys.pop(0)
+        clock.delay(delay)
+        self._time = clock.get()
+        if not self._keys:
+            # the answer has been committed
+            self.nResponses += 1
+            self._keys = None
+            self._read = len(self.video.history)
+        return VirtualKey(name), (clock.get(), 0)
+
+class VirtualKeyTrack(object):
+    """
+    Keyboard track whose key choosers are a simulated responder.
+
+    If no responder is given, a SimulatedTypist reading from video
+    is created for the first key chooser.
+    """
+
+    def __init__(self, responder, video=None):
+        self.responder = responder
+        self.video = video
+
+    def keyChooser(self, *keyNames):
+        if self.responder is None:
+            self.responder = SimulatedTypist(self.video)
+        return self.responder
+
+class HeadlessBackend(object):
+    """
+    Backend for math_distract that runs on virtual time.
+
+    Has the same interface as math_distract.PyEPLBackend. Use the
+    backend's clock for presentation, so that all stand-ins share
+    the same virtual time.
+
+    Inputs
+    ------
+    responder : SimulatedResponder or SimulatedTypist
+        Simulated participant. If None, a responder is created for
+        the keys of each button chooser (or a typist for the key
+        chooser of typed answers), with the default options.
+    seed : seed or numpy.random.RandomState
+        Source of random jitter for the clock.
+    frameLatency : int
+        Maximum latency (ms) reported for each screen update.
+    """
+
+    RIGHT = 'RIGHT'
+
+    def __init__(self, responder=None, seed=None, frameLatency=0):
+        self.responder = responder
+        self.clock = VirtualClock(seed=seed)
+        self.video = VirtualVideoTrack(self.clock, frameLatency)
+        self.audio = VirtualAudioTrack(self.clock)
+        if (isinstance(responder, SimulatedTypist) and
+            responder.video is None):
+            responder.video = self.video
+        self.keyboard = VirtualKeyTrack(responder, self.video)
+        self.text_cache = math_distract.TextCache(factory=VirtualText)
+        self.beep_cache = math_distract.BeepCache(factory=VirtualBeep)
+        self.logs = {}
+
+    def Clock(self):
+        """Get the virtual clock."""
+        return self.clock
+
+    def ButtonChooser(self, *keyNames):
+        """Get the simulated responder."""
+        if self.responder is None:
+            self.responder = SimulatedResponder(keyNames)
+            self.keyboard.responder = self.responder
+        return self.responder
+
+    def LogTrack(self, name):
+        """Create a log that keeps records in memory."""
+        log = VirtualLogTrack(name)
+        self.logs[name] = log
+        return log
+
+    def now(self):
+        """Get the current virtual time."""
+        return self.clock.get()
+
+class _State(object):
+    """
+    Saved experiment state.
+    """
+    pass
+
+class _Session(object):
+    def __init__(self, path):
+        self.path = path
+
+    def fullPath(self):
+        if self.path is None:
+            self.path = tempfile.mkdtemp(prefix='math_distract_')
+        return self.path
+
+class VirtualExperiment(object):
+    """
+    Stand-in for a PyEPL Experiment that keeps its state in memory.
+
+    Inputs
+    ------
+    sessionPath : str
+        Directory for session files (e.g. binary logs). If None, a
+        temporary directory is created when it is first needed.
+    """
+
+    def __init__(self, sessionPath=None):
+        self.state = None
+        self.session = _Session(sessionPath)
+
+    def restoreState(self):
+        return self.state
+
+    def saveState(self, state, **kwargs):
+        if state is None:
+            state = _State()
+        for name, value in kwargs.items():
+            setattr(state, name, value)
+        self.state = state
+
+def simulate_session(config, responder=None, seed=None,
+                     sessionPath=None):
+    """
+    Prepare and run a session of distract_pres on virtual time.
+
+    Inputs
+    ------
+    config : object
+        Configuration variables, as in config_distract_pres.py.
+    responder : SimulatedResponder or SimulatedTypist
+    seed : seed or numpy.random.RandomState
+        Source of random jitter for the clock.
+    sessionPath : str
+        Directory for session files (see VirtualExperiment).
+
+    Outputs
+    -------
+    backend : HeadlessBackend
+        Backend used to run the session. backend.logs holds the
+        session and math logs.
+    """
+
+    import distract_pres
+    
+    exp = VirtualExperiment(sessionPath)
+    distract_pres.prepare(exp, config)
+    backend = HeadlessBackend(responder, seed)
+    distract_pres.run(exp, config, backend)
+    return backend
@@ -0,0 +1,167 @@
+"""
+Fixed-schema binary math log.
+
+Each event logged by math_distract is written as a fixed-size record,
+so a whole session can be loaded as a NumPy structured array without
+parsing. Files start with a short header, followed by the records.
+
+Record fields
+-------------
+event : uint8
+    Event type; index into EVENTS.
+correct : int8
+    1 if correct, 0 if incorrect, -1 if no response (or not a PROB
+    or BEEP event).
+trial : int32
+    Trial (set) number.
+item : int32
+    Value of the term for TERM events; number of the problem within
+    the set for PROB and BEEP events; character code of the key for
+    KEY events (see math_distract.KeyBuffer.code). MISSING if not
+    applicable.
+proposed : int32
+    Proposed answer for PROB events, or MISSING.
+rt : int32
+    Reaction time (ms) for PROB and KEY events, or -1.
+latency : int32
+    Maximum latency (ms) of the reaction time for PROB and KEY
+    events, or of the timestamp for other events.
+time : int64
+    Timestamp (ms).
+"""
+
+import os
+import struct
+import numpy
+
+# event types, in the order of their codes
+EVENTS = ('MATH START', 'TERM', 'PROB', 'REST', 'MATH END', 'KEY',
+          'BEEP')
+
+# value used for missing integer fields
+MISSING = -2 ** 31
+
+RECORD_DTYPE = numpy.dtype([('event', 'u1'), ('correct', 'i1'),
+                            ('trial', '<i4'), ('item', '<i4'),
+                            ('proposed', '<i4'), ('rt', '<i4'),
+                            ('latency', '<i4'), ('time', '<i8')])
+
+_record = struct.Struct('<Bbiiiiiq')
+
+# magic, version, record size
+_header = struct.Struct('<4sHH')
+_magic = b'MDLG'
+_version = 1
+
+def event_code(name):
+    """
+    Get the code for an event type.
+    """
+    return EVENTS.index(name)
+
+def _split_timestamp(timestamp):
+    """
+    Split a timestamp into time and maximum latency.
+    """
+    if isinstance(timestamp, tuple):
+        return timestamp[0], timestamp[1]
+    return timestamp, 0
+
+class BinaryMathLog(object):
+    """
+    Writer for binary math logs.
+
+    Inputs
+    ------
+    filename : str
+        File to write to. If it exists, records are appended, after
+        dropping any partial record at the end (e.g. from a crash).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        if os.path.exists(filename) and os.path.getsize(filename) > 0:
+            _read_header(filename)
+
+            # drop any partial record left by a crash, so that new
+            # records stay aligned
+            size = os.path.getsize(filename)
+            n_records = (size - _header.size) // _record.size
+            valid = _header.size + n_records * _record.size
+            self._file = open(filename, 'r+b')
+            if valid < size:
+                self._file.truncate(valid)
+            self._file.seek(valid)
+        else:
+            self._file = open(filename, 'wb')
+            self._file.write(_header.pack(_magic, _version, _record.size))
+
+    def write(self, event, trial, timestamp, item=MISSING,
+              proposed=MISSING, correct=-1, rt=-1, latency=None):
+        """
+        Write one record.
+
+        Inputs
+        ------
+        event : str
+            Event type (see EVENTS).
+        trial : int
+        timestamp : int or (int, int)
+            Time of the event, optionally with its maximum latency.
+        item : int
+        proposed : int
+        correct : int
+        rt : int
+        latency : int
+            Maximum latency; default is the latency of timestamp.
+        """
+        time, time_latency = _split_timestamp(timestamp)
+        if latency is None:
+            latency = time_latency
+        self._file.write(_record.pack(event_code(event), correct, trial,
+                                      item, proposed, rt, latency, time))
+
+    def flush(self):
+        """Write buffered records to disk."""
+        self._file.flush()
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+def _read_header(filename):
+    """
+    Check the header of a binary math log.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read(_header.size)
+    if len(data) < _header.size:
+        raise ValueError("%s is not a binary math log." % filename)
+    magic, version, size = _header.unpack(data)
+    if magic != _magic:
+        raise ValueError("%s is not a binary math log." % filename)
+    if version != _version or size != RECORD_DTYPE.itemsize:
+        raise ValueError("%s has an unsupported format version." %
+                         filename)
+
+def read_binary_log(filename):
+    """
+    Load a binary math log.
+
+    The file is memory-mapped, so records are only read from disk as
+    they are accessed. A partial record at the end of the file (e.g.
+    if the session crashed while it was being written) is ignored.
+
+    Outputs
+    -------
+    records : numpy.ndarray
+        Read-only structured array with dtype RECORD_DTYPE.
+    """
+
+    _read_header(filename)
+    n_records = ((os.path.getsize(filename) - _header.size) //
+                 RECORD_DTYPE.itemsize)
+    if n_records == 0:
+        return numpy.zeros(0, dtype=RECORD_DTYPE)
+    return numpy.memmap(filename, dtype=RECORD_DTYPE, mode='r',
+                        offset=_header.size, shape=(n_records,))
@@ -1,26 +1,681 @@
-from pyepl import display
-from pyepl import sound
-from pyepl.keyboard import Key, KeyTrack
-from pyepl import joystick
-from pyepl.mouse import MouseRoller, MouseButton
-from pyepl import keyboard
-from pyepl import mechinput
-from pyepl import hardware
-from pyepl.textlog import LogTrack
-from pyepl import exputils
-from pyepl import convenience
-
-import pygame
-from pyepl import timing
+import threading
+from collections import deque
 import prep_math
+import math_binlog
 
-def run_problem(terms, ops, answer, v, clock, mathlog, textSize,
-                endTime, ans_but, trialNum=None, numberDuration=None,
-                numberISI=None, tfProblems=False, tfKeys=None, 
-                proposed=None, scoreDisplay=None, presentSeq=False,
-                showEquals=False):
+class TextCache(object):
     """
-    Present a  math problem and record a response.
+    Cache of Text showables, so that the same text is not rendered
+    again for each problem.
+
+    Inputs
+    ------
+    maxsize : int
+        Maximum number of Text objects to keep. The least recently
+        used text is discarded first.
+    factory : callable
+        Called as factory(text, font=font, size=size) to create
+        text. Default is display.Text.
+
+    Notes
+    -----
+    Text created with font=None uses the default font at the time
+    it is first requested; clear the cache after changing the
+    default font.
+    """
+
+    def __init__(self, maxsize=256, factory=None):
+        self._cache = prep_math.LRUCache(maxsize)
+        self._lock = threading.Lock()
+        self.factory = factory
+
+    def get(self, text, size=None, font=None):
+        """
+        Get a Text showable for a string.
+
+        Text may be requested from more than one thread (e.g. by a
+        SetPreparer).
+        """
+        key = (text, size, font)
+        with self._lock:
+            showable = self._cache.get(key)
+            if showable is None:
+                if self.factory is None:
+                    from pyepl import display
+                    showable = display.Text(text, font=font, size=size)
+                else:
+                    showable = self.factory(text, font=font, size=size)
+                self._cache[key] = showable
+        return showable
+
+    def clear(self):
+        """Remove all cached text."""
+        with self._lock:
+            self._cache.clear()
+
+# text shared by all problems and sets
+text_cache = TextCache()
+
+class BeepCache(object):
+    """
+    Cache of synthesized beeps, so that feedback sounds are only
+    synthesized once per session instead of once per set.
+
+    Inputs
+    ------
+    factory : callable
+        Called as factory(freq, duration, rampDuration) to create a
+        beep. Default is sound.Beep.
+    """
+
+    def __init__(self, factory=None):
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.factory = factory
+
+    def get(self, freq, duration, rampDuration):
+        """
+        Get a beep with some frequency (Hz), duration (ms), and ramp
+        duration (ms).
+        """
+        key = (freq, duration, rampDuration)
+        with self._lock:
+            beep = self._cache.get(key)
+            if beep is None:
+                if self.factory is None:
+                    from pyepl import sound
+                    beep = sound.Beep(freq, duration, rampDuration)
+                else:
+                    beep = self.factory(freq, duration, rampDuration)
+                self._cache[key] = beep
+        return beep
+
+    def clear(self):
+        """Remove all cached beeps."""
+        with self._lock:
+            self._cache.clear()
+
+# beeps shared by all sets
+beep_cache = BeepCache()
+
+# problems that get a feedback beep for each feedback mode
+FEEDBACK_MODES = {'none': (), 'incorrect': (0,), 'correct': (1,),
+                  'both': (0, 1)}
+
+class PyEPLBackend(object):
+    """
+    Presentation backend using the current PyEPL tracks.
+
+    run_math_set gets its video, audio, keyboard, clock, text, and
+    sounds from a backend, so that other backends (see headless.py)
+    can be substituted. PyEPL is only imported once presentation
+    starts, so the rest of this module can be used without it.
+    """
+
+    def __init__(self):
+        from pyepl import display, sound, keyboard
+        self.video = display.VideoTrack.lastInstance()
+        self.audio = sound.AudioTrack.lastInstance()
+        self.keyboard = keyboard.KeyTrack.lastInstance()
+        self.text_cache = text_cache
+        self.beep_cache = beep_cache
+        self.RIGHT = display.RIGHT
+
+    def Clock(self):
+        """Create a presentation clock."""
+        from pyepl import exputils
+        return exputils.PresentationClock()
+
+    def ButtonChooser(self, *keyNames):
+        """Create a button chooser for some keys."""
+        from pyepl import mechinput
+        from pyepl.keyboard import Key
+        return mechinput.ButtonChooser(*[Key(x) for x in keyNames])
+
+    def LogTrack(self, name):
+        """Create a log."""
+        from pyepl.textlog import LogTrack
+        return LogTrack(name)
+
+    def now(self):
+        """Get the current time (ms)."""
+        from pyepl import timing
+        return timing.now()
+
+class MathLogBuffer(object):
+    """
+    Math log that queues records in memory and writes them later.
+
+    Records are kept as (format, args, timestamp) tuples, so that
+    neither formatting nor file I/O happens when a record is logged.
+    Records are written in order, in the same format as logging
+    directly to the log.
+
+    Inputs
+    ------
+    log : LogTrack
+        Log to write records to.
+    background : bool
+        If true, a background thread writes records soon after they
+        are logged. Otherwise, records are only written when flush
+        is called.
+    """
+
+    def __init__(self, log, background=False):
+        self.log = log
+        self._records = deque()
+        self._lock = threading.Lock()
+        self._closed = False
+        if background:
+            self._ready = threading.Event()
+            self._thread = threading.Thread(target=self._write_loop)
+            self._thread.daemon = True
+            self._thread.start()
+        else:
+            self._ready = None
+            self._thread = None
+
+    def logRecord(self, fmt, args, timestamp=None):
+        """
+        Queue a record to be formatted as fmt % args.
+        """
+        if timestamp is None:
+            from pyepl import timing
+            timestamp = timing.now()
+        self._records.append((fmt, args, timestamp))
+        if self._ready is not None:
+            self._ready.set()
+
+    def logMessage(self, message, timestamp=None):
+        """
+        Queue a preformatted message.
+        """
+        self.logRecord('%s', (message,), timestamp)
+
+    def flush(self):
+        """
+        Write all queued records to the log.
+        """
+        with self._lock:
+            while self._records:
+                fmt, args, timestamp = self._records.popleft()
+                self.log.logMessage(fmt % args, timestamp)
+
+    def close(self):
+        """
+        Stop the background thread (if any) and write all records.
+        """
+        self._closed = True
+        if self._thread is not None:
+            self._ready.set()
+            self._thread.join()
+        self.flush()
+
+    def _write_loop(self):
+        while not self._closed:
+            self._ready.wait()
+            self._ready.clear()
+            self.flush()
+
+class SetPreparer(object):
+    """
+    Prepare problem sets on a background thread, one set ahead.
+
+    Set i is generated from prep_math.child_seed(seed, i), so it is
+    the same as set i from prep_math.prep_problem_sets, and can be
+    prepared without preparing the sets before it. If options
+    includes a registry (see prep_math.ProblemRegistry), sets depend
+    on the sets before them, so any skipped sets are generated
+    first. Only the set being prepared and the set that was last
+    returned by get are kept in memory.
+
+    Inputs
+    ------
+    seed : int or tuple of ints
+        Seed for the session.
+    options : dict
+        Options for prep_math.prep_math_set.
+    render : callable
+        Called with each prepared ProblemSet on the worker thread,
+        e.g. to render its text.
+    """
+
+    def __init__(self, seed, options, render=None):
+        self.seed = seed
+        self.options = options
+        self.render = render
+        self._next = 0
+        self._index = None
+        self._thread = None
+        self._result = None
+        self._error = None
+
+    def start(self, index):
+        """
+        Start preparing a set in the background.
+        """
+        if self._index == index:
+            return
+        self.wait()
+        self._index = index
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(index,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wait(self):
+        """
+        Wait for the set being prepared (if any) to be ready.
+        """
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def get(self, index):
+        """
+        Get a prepared set, waiting for it if it is not ready.
+
+        Outputs
+        -------
+        problems : prep_math.ProblemSet
+            ProblemSet with one set.
+        """
+        self.start(index)
+        self.wait()
+        result, error = self._result, self._error
+        self._index = None
+        self._result = None
+        self._error = None
+        if error is not None:
+            raise error
+        return result
+
+    def _run(self, index):
+        try:
+            self._result = self._prepare(index)
+        except Exception as err:
+            self._error = err
+
+    def _prepare(self, index):
+        if self.options.get('registry') is not None:
+            # generate any skipped sets, so the registry is the same
+            # as if every set had been prepared in order
+            for i in range(self._next, index):
+                prep_math.prep_math_set(
+                    seed=prep_math.child_seed(self.seed, i),
+                    **self.options)
+        self._next = index + 1
+
+        terms, ops, answers, proposed = prep_math.prep_math_set(
+            seed=prep_math.child_seed(self.seed, index), **self.options)
+        problems = prep_math.ProblemSet.from_lists([terms], [ops],
+                                                   [answers], [proposed])
+        if self.render is not None:
+            self.render(problems)
+        return problems
+
+class TimingRecorder(object):
+    """
+    Record the intended and actual onsets of stimuli in a set.
+
+    Inputs
+    ------
+    tolerance : float
+        Maximum onset error (ms) that is tolerated. Sets with any
+        larger error are flagged as drifted. Onsets are delayed to
+        the next screen refresh, so this should be at least one
+        frame; default is frameDuration.
+    frameDuration : float
+        Duration (ms) of one frame. Onsets that are late by at least
+        this much are counted as late frames.
+    latencyBins : list of numbers
+        Lower edges (ms) of the bins for the histogram of maximum
+        latencies.
+    """
+
+    def __init__(self, tolerance=None, frameDuration=1000. / 60,
+                 latencyBins=(0, 1, 2, 5, 10, 20, 50)):
+        if tolerance is None:
+            tolerance = frameDuration
+        self.tolerance = tolerance
+        self.frameDuration = frameDuration
+        self.latencyBins = list(latencyBins)
+        self.reset()
+
+    def reset(self):
+        """Remove all records."""
+        self.events = []
+
+    def record(self, event, intended, timestamp):
+        """
+        Record one event.
+
+        Inputs
+        ------
+        event : str
+            Type of event (e.g. 'TERM').
+        intended : int
+            Intended onset time, or None if the event did not have a
+            scheduled onset (e.g. a response).
+        timestamp : (int, int)
+            Actual time of the event and its maximum latency.
+        """
+        self.events.append((event, intended, timestamp[0], timestamp[1]))
+
+    def summary(self):
+        """
+        Summarize onset errors and latencies.
+
+        Outputs
+        -------
+        summary : dict
+            n_onsets : number of onsets with an intended time
+            mean_error : mean onset error (ms; actual - intended)
+            max_error : largest absolute onset error
+            n_late : number of onsets late by a frame or more
+            latency_bins : lower edges of the latency histogram bins
+            latency_counts : number of events in each latency bin
+            max_latency : largest maximum latency
+            drifted : true if max_error is larger than tolerance
+        """
+
+        errors = [actual - intended
+                  for event, intended, actual, latency in self.events
+                  if intended is not None]
+        counts = [0] * len(self.latencyBins)
+        for event, intended, actual, latency in self.events:
+            for i in range(len(self.latencyBins) - 1, -1, -1):
+                if latency >= self.latencyBins[i]:
+                    counts[i] += 1
+                    break
+
+        if errors:
+            mean_error = float(sum(errors)) / len(errors)
+            max_error = max(abs(x) for x in errors)
+        else:
+            mean_error = 0.
+            max_error = 0
+        if self.events:
+            max_latency = max(x[3] for x in self.events)
+        else:
+            max_latency = 0
+        n_late = len([x for x in errors if x >= self.frameDuration])
+        return {'n_onsets': len(errors), 'mean_error': mean_error,
+                'max_error': max_error, 'n_late': n_late,
+                'latency_bins': list(self.latencyBins),
+                'latency_counts': counts, 'max_latency': max_latency,
+                'drifted': max_error > self.tolerance}
+
+class DeadlineSchedule(object):
+    """
+    Absolute onset deadlines for the problems in a set.
+
+    Jitter for every problem ISI is drawn at the start of the set.
+    Each problem's onset is then set from the end of the previous
+    problem, and the onset of each term, term ISI, and proposed
+    answer is fixed relative to it, so that overruns in rendering,
+    logging, or sound playback are absorbed instead of adding up
+    over the set.
+
+    Inputs
+    ------
+    seed : seed or numpy.random.RandomState
+        Source of the ISI jitter (see prep_math.get_rng).
+
+    Attributes
+    ----------
+    problems : list of dict
+        Schedule of each problem planned in the current set, with
+        keys onset, jitter, and events (a list of (event, deadline)
+        pairs in the order they are presented).
+    """
+
+    def __init__(self, seed=None):
+        self.rng = prep_math.get_rng(seed)
+        self.reset(0, 0)
+
+    def reset(self, nProblems, probJitter):
+        """Draw the jitter for up to nProblems problems."""
+        self.jitter = self.rng.randint(0, probJitter + 1, nProblems)
+        self.probJitter = probJitter
+        self.problems = []
+
+    def plan(self, end, nItems, presentSeq, numberDuration, numberISI,
+             probISI):
+        """
+        Plan the next problem.
+
+        Inputs
+        ------
+        end : int
+            Time that the previous problem ended, or the start of the
+            set for the first problem.
+        nItems : int
+            Number of items presented one at a time (presentSeq only).
+
+        Outputs
+        -------
+        problem : dict
+            Schedule of the problem (see problems).
+        """
+
+        i = len(self.problems)
+        if i == 0:
+            jitter = 0
+            onset = end
+        else:
+            if i < len(self.jitter):
+                jitter = int(self.jitter[i])
+            else:
+                jitter = int(self.rng.randint(0, self.probJitter + 1))
+            onset = end + probISI + jitter
+
+        events = []
+        if presentSeq:
+            for j in range(nItems):
+                t = onset + j * (numberDuration + numberISI)
+                if j > 0 and numberISI > 0:
+                    events.append(('ISI', t - numberISI))
+                events.append(('TERM', t))
+            t = onset + nItems * (numberDuration + numberISI)
+            if numberISI > 0:
+                events.append(('ISI', t - numberISI))
+            events.append(('ANSWER', t))
+        else:
+            events.append(('ANSWER', onset))
+
+        problem = {'onset': onset, 'jitter': jitter, 'events': events}
+        self.problems.append(problem)
+        return problem
+
+def _wait(clock, duration, deadline=None):
+    """
+    Wait for duration ms, or until deadline if it is given.
+    """
+    if deadline is None:
+        clock.delay(duration)
+    elif deadline > clock.get():
+        clock.delay(deadline - clock.get())
+
+def _update_screen(v, clock, timing, event):
+    """
+    Update the screen, recording the intended and actual onset.
+    """
+    intended = clock.get()
+    ts = v.updateScreen(clock)
+    if timing is not None:
+        timing.record(event, intended, ts)
+    return ts
+
+def _log_record(mathlog, fmt, args, timestamp):
+    """
+    Log fmt % args, deferring formatting if the log supports it.
+    """
+    if isinstance(mathlog, MathLogBuffer):
+        mathlog.logRecord(fmt, args, timestamp)
+    else:
+        mathlog.logMessage(fmt % args, timestamp)
+
+class PreparedProblem(object):
+    """
+    A math problem with everything needed to present it.
+
+    Attributes
+    ----------
+    probtxt : str
+        Left-hand side of the problem, for presentation/logging.
+    rstr : str
+        Right-hand side of the problem.
+    corRsp : str
+        Name of the correct key (true/false problems only).
+    labels : list of strs
+        Strings presented sequentially (sequential presentation
+        only).
+    text : list of Text
+        Text for each string in labels.
+    probText : Text
+        Text for the left-hand side (simultaneous presentation
+        only).
+    respText : Text
+        Text for the right-hand side.
+    """
+
+    def __init__(self, probtxt, rstr, corRsp, labels, text, probText,
+                 respText):
+        self.probtxt = probtxt
+        self.rstr = rstr
+        self.corRsp = corRsp
+        self.labels = labels
+        self.text = text
+        self.probText = probText
+        self.respText = respText
+
+class KeyBuffer(object):
+    """
+    Keystrokes of a typed answer.
+
+    Keys are added as they are pressed. Digits are appended to the
+    answer, '-' is accepted as the first character only, BACKSPACE
+    removes the last character, and ENTER or RETURN commits the
+    answer. Keypad keys (e.g. '[5]') are treated like the
+    corresponding main keys. Every key is recorded with its
+    timestamp, whether or not it changed the answer.
+
+    Inputs
+    ------
+    maxLength : int
+        Maximum number of characters in the answer. Further digits
+        are recorded but ignored.
+
+    Attributes
+    ----------
+    text : str
+        Answer typed so far.
+    events : list of (str, int, int)
+        Name, time, and maximum latency of each key.
+    committed : bool
+        True once the answer has been committed.
+    """
+
+    # map from key names to the characters they type
+    KEYS = dict([(str(i), str(i)) for i in range(10)] +
+                [('[%d]' % i, str(i)) for i in range(10)] +
+                [('-', '-'), ('[-]', '-')])
+    COMMIT = ('ENTER', 'RETURN')
+    DELETE = ('BACKSPACE',)
+
+    def __init__(self, maxLength=6):
+        self.maxLength = maxLength
+        self.text = ''
+        self.events = []
+        self.committed = False
+
+    def press(self, name, timestamp):
+        """
+        Add a key to the buffer.
+
+        Inputs
+        ------
+        name : str
+            Name of the key.
+        timestamp : (int, int)
+            Time of the key and its maximum latency.
+
+        Outputs
+        -------
+        changed : bool
+            True if the typed answer changed.
+        """
+
+        self.events.append((name, timestamp[0], timestamp[1]))
+        if self.committed:
+            return False
+        if name in self.COMMIT:
+            self.committed = True
+            return False
+        if name in self.DELETE:
+            if not self.text:
+                return False
+            self.text = self.text[:-1]
+            return True
+        char = self.KEYS.get(name)
+        if char is None or len(self.text) >= self.maxLength:
+            return False
+        if char == '-' and self.text:
+            return False
+        self.text += char
+        return True
+
+    def first(self):
+        """Time and maximum latency of the first key, or None."""
+        if not self.events:
+            return None
+        return self.events[0][1:]
+
+    def last(self):
+        """Time and maximum latency of the last key, or None."""
+        if not self.events:
+            return None
+        return self.events[-1][1:]
+
+    def code(self, name):
+        """
+        Character code of a key, for binary logs.
+
+        Typing keys give the code of their character, ENTER and
+        RETURN give 10 (newline), and BACKSPACE gives 8. Other keys
+        give math_binlog.MISSING.
+        """
+        if name in self.COMMIT:
+            return 10
+        if name in self.DELETE:
+            return 8
+        char = self.KEYS.get(name)
+        if char is None:
+            return math_binlog.MISSING
+        return ord(char)
+
+    def value(self):
+        """Typed answer as an int, or None if it is not a number."""
+        if not self.text.lstrip('-'):
+            return None
+        return int(self.text)
+
+def prepare_problem(terms, ops, answer, textSize, tfProblems=False,
+                    tfKeys=None, proposed=None, presentSeq=False,
+                    showEquals=False, textCache=None):
+    """
+    Prepare the text and correct response for a math problem.
+
+    Doing this before the problem's onset (e.g. during the ISI
+    before it) means that presenting the problem only requires
+    showing the text and updating the screen. Text is taken from
+    textCache (default is the module text_cache).
+
+    Outputs
+    -------
+    prepared : PreparedProblem
     """
 
     if tfProblems:
@@ -31,87 +686,203 @@ def run_problem(terms, ops, answer, v, clock, mathlog, textSize,
             corRsp = tfKeys[1]
         rstr = str(proposed)
     else:
+        corRsp = None
         rstr = ''
 
-    # display the current score
-    if scoreDisplay is not None:
-        ct = v.showProportional(scoreDisplay, .8, .1)
-
     # get problem text for presentation/logging
     probanswer, probtxt = prep_math.eval_problem(terms, ops)
     
+    if textCache is None:
+        textCache = text_cache
+    
+    text = []
+    s = []
     if presentSeq:
         # present each term, without the operator(s). Assuming that
         # the operators are always the same, so they do not need to
         # be shown on each trial
-        text = []
-        s = []
         for x in terms:
             s.append(str(x))
-            text.append(display.Text(str(x), size=textSize))
+            text.append(textCache.get(str(x), textSize))
         
         if showEquals:
             s.append('=')
-            text.append(display.Text('=', size=textSize))
+            text.append(textCache.get('=', textSize))
         else:
             rstr += '?'
+        probText = None
+    else:
+        probText = textCache.get(probtxt, textSize)
+    respText = textCache.get(rstr, textSize)
+
+    return PreparedProblem(probtxt, rstr, corRsp, s, text, probText,
+                           respText)
+
+def _log_entry(entry, trialNum, probstart, mathlog, binlog=None):
+    """
+    Log the keys of a typed answer.
+
+    Each key is logged with its RT and maximum latency relative to
+    the onset of the problem. A summary is then logged with the
+    typed answer, the RT to the first key, and the RT to the commit
+    (blank if there was no key or no commit).
+    """
+
+    for name, t, latency in entry.events:
+        key_rt = (t - probstart[0], latency + probstart[1])
+        _log_record(mathlog, 'KEY\t%d\t%s\t%ld\t%d\t\t',
+                    (trialNum, name, key_rt[0], key_rt[1]), (t, latency))
+        if binlog is not None:
+            binlog.write('KEY', trialNum, (t, latency),
+                         item=entry.code(name), rt=key_rt[0],
+                         latency=key_rt[1])
 
+    fields = []
+    for timestamp in (entry.first(), entry.committed and entry.last()):
+        if timestamp:
+            fields.extend(['%d' % (timestamp[0] - probstart[0]),
+                           '%d' % (timestamp[1] + probstart[1])])
+        else:
+            fields.extend(['', ''])
+    _log_record(mathlog, 'ENTRY\t%d\t%r\t%s\t%s\t%s\t%s',
+                (trialNum, entry.text) + tuple(fields), probstart)
+
+def run_problem(terms, ops, answer, v, clock, mathlog, textSize,
+                endTime, ans_but, trialNum=None, numberDuration=None,
+                numberISI=None, tfProblems=False, tfKeys=None, 
+                proposed=None, scoreDisplay=None, presentSeq=False,
+                showEquals=False, prepared=None, binlog=None,
+                probNum=None, backend=None, timing=None, deadlines=None):
+    """
+    Present a  math problem and record a response.
+
+    If prepared is given (see prepare_problem), the text prepared
+    for the problem is used; otherwise it is prepared first. If
+    binlog (a math_binlog.BinaryMathLog) is given, events are also
+    written to it; probNum is the number of the problem within the
+    set. backend (default PyEPLBackend) supplies text and layout.
+    If timing (a TimingRecorder) is given, the intended and actual
+    onset of each screen update is recorded. If deadlines (the
+    events of a DeadlineSchedule plan) is given, each term and ISI
+    ends at its scheduled deadline instead of after a fixed delay.
+    """
+
+    if backend is None:
+        backend = PyEPLBackend()
+    if prepared is None:
+        prepared = prepare_problem(terms, ops, answer, textSize,
+                                   tfProblems, tfKeys, proposed,
+                                   presentSeq, showEquals,
+                                   backend.text_cache)
+    corRsp = prepared.corRsp
+    rstr = prepared.rstr
+    probtxt = prepared.probtxt
+    s = prepared.labels
+
+    # display the current score
+    if scoreDisplay is not None:
+        ct = v.showProportional(scoreDisplay, .8, .1)
+
+    # time that each screen update ends: the deadline of the event
+    # after it
+    if deadlines is not None:
+        ends = [t for event, t in deadlines[1:]] + [None]
+    else:
+        ends = [None] * (2 * len(prepared.text) + 1)
+    ends = iter(ends)
+
+    prestime = []
+    if presentSeq:
         tt = None
-        prestime = []
-        for x in text:
+        for x in prepared.text:
             # remove the previous term
             if tt is not None:
                 v.unshow(tt)
             
                 # if ISI, show blank screen
                 if numberISI > 0:
-                    v.updateScreen(clock)
-                    clock.delay(numberISI)
+                    _update_screen(v, clock, timing, 'ISI')
+                    _wait(clock, numberISI, next(ends))
 
             # show the next term
             tt = v.showCentered(x)
-            ts = v.updateScreen(clock)
+            ts = _update_screen(v, clock, timing, 'TERM')
             prestime.append(ts)
-            clock.delay(numberDuration)
+            _wait(clock, numberDuration, next(ends))
 
         # ISI before the proposed answer
         v.unshow(tt)
         if numberISI > 0:
-            v.updateScreen(clock)
-            clock.delay(numberISI)
+            _update_screen(v, clock, timing, 'ISI')
+            _wait(clock, numberISI, next(ends))
 
         # we've logged the parts of the problem preceding the proposed
         # answer; the last log line is the time that the proposed
         # answer was presented, and the RT to respond to that
-        rt = v.showCentered(display.Text(rstr, size=textSize))
-        probstart = v.updateScreen(clock)
+        rt = v.showCentered(prepared.respText)
+        probstart = _update_screen(v, clock, timing, 'ANSWER')
     else:
         # show the left-hand side
-        pt = v.showProportional(display.Text(probtxt, size=textSize),
+        pt = v.showProportional(prepared.probText,
                                 .5 - textSize, .5)
 
         # show the right-hand side (if applicable)
-        rt = v.showRelative(display.Text(rstr, size=textSize),
-                            display.RIGHT,pt)
-        probstart = v.updateScreen(clock)
+        rt = v.showRelative(prepared.respText,
+                            backend.RIGHT,pt)
+        probstart = _update_screen(v, clock, timing, 'ANSWER')
 
     # wait for keypress
-    maxTimeLeft = endTime - clock.get()
-    kret, resptime = ans_but.waitWithTime(maxDuration=maxTimeLeft,
-                                          clock=clock)
+    entry = None
+    if tfProblems:
+        maxTimeLeft = endTime - clock.get()
+        kret, resptime = ans_but.waitWithTime(maxDuration=maxTimeLeft,
+                                              clock=clock)
+    else:
+        # collect keys until the answer is committed, redrawing only
+        # the answer field when it changes
+        entry = KeyBuffer()
+        while not entry.committed:
+            maxTimeLeft = endTime - clock.get()
+            if maxTimeLeft <= 0:
+                break
+            key, keytime = ans_but.waitWithTime(maxDuration=maxTimeLeft,
+                                                clock=clock)
+            if key is None:
+                break
+            if entry.press(key.name, keytime):
+                if entry.text:
+                    field = backend.text_cache.get(entry.text, textSize)
+                else:
+                    field = prepared.respText
+                rt = v.replace(rt, field)
+                _update_screen(v, clock, timing, 'KEY')
+        if entry.committed:
+            kret = key
+            resptime = entry.last()
+        else:
+            kret = None
+    if timing is not None and kret is not None:
+        timing.record('RESPONSE', None, resptime)
 
     for i in range(len(prestime)):
         # log each term presentation
-        mathlog.logMessage('TERM\t%d\t%s\t\t\t\t' % (trialNum, s[i]), 
-                           prestime[i])
+        _log_record(mathlog, 'TERM\t%d\t%s\t\t\t\t', (trialNum, s[i]),
+                    prestime[i])
+        if binlog is not None:
+            if s[i].lstrip('-').isdigit():
+                item = int(s[i])
+            else:
+                item = math_binlog.MISSING
+            binlog.write('TERM', trialNum, prestime[i], item=item)
 
-    # NWM: keypad entry and audio code are more complex, so leaving
-    # them out for now. Code above should support those response
-    # types, but they are not supported in code below
+    # NWM: audio code is more complex, so leaving it out for now
+    if entry is not None and entry.text:
+        # log whatever was typed, even if it was not committed
+        rstr = entry.text
     if kret is None:
         timeout = True
         isCorrect = None
-    elif tfProblems:            
+    elif tfProblems:
         # check the answer
         timeout = False
         if kret.name == corRsp:
@@ -119,7 +890,12 @@ def run_problem(terms, ops, answer, v, clock, mathlog, textSize,
         else:
             isCorrect = 0
     else:
-        raise ValueError('Keyboard and vocal responses currently not supported.')
+        # check the typed answer
+        timeout = False
+        if entry.value() == answer:
+            isCorrect = 1
+        else:
+            isCorrect = 0
 
     if kret is not None:
         # calc the RT as (RT, maxlatency)
@@ -131,24 +907,44 @@ def run_problem(terms, ops, answer, v, clock, mathlog, textSize,
             trialNum = -1
 
         # log the problem presentation, accuracy, and reaction time
-        mathlog.logMessage('PROB\t%d\t%r\t%r\t%d\t%ld\t%d' %
-                           (trialNum, probtxt, rstr, isCorrect,
-                            prob_rt[0], prob_rt[1]), probstart)
+        _log_record(mathlog, 'PROB\t%d\t%r\t%r\t%d\t%ld\t%d',
+                    (trialNum, probtxt, rstr, isCorrect,
+                     prob_rt[0], prob_rt[1]), probstart)
     else:
         # no response; still log the problem presentation
-        mathlog.logMessage('PROB\t%d\t%r\t%r\t\t\t' %
-                           (trialNum, probtxt, rstr), probstart)
+        _log_record(mathlog, 'PROB\t%d\t%r\t%r\t\t\t',
+                    (trialNum, probtxt, rstr), probstart)
+
+    if binlog is not None:
+        if probNum is None:
+            probNum = math_binlog.MISSING
+        if tfProblems:
+            binProposed = proposed
+        else:
+            binProposed = math_binlog.MISSING
+        if kret is not None:
+            binlog.write('PROB', trialNum, probstart, item=probNum,
+                         proposed=binProposed, correct=isCorrect,
+                         rt=prob_rt[0], latency=prob_rt[1])
+        else:
+            binlog.write('PROB', trialNum, probstart, item=probNum,
+                         proposed=binProposed)
+
+    if entry is not None:
+        if trialNum is None:
+            trialNum = -1
+        _log_entry(entry, trialNum, probstart, mathlog, binlog)
 
     # clear the problem
     if presentSeq:
         v.unshow(rt)
     else:
         v.unshow(pt, rt)
-    v.updateScreen(clock)
+    _update_screen(v, clock, timing, 'ISI')
 
     return isCorrect, timeout, probstart
 
-def run_math_set(terms, ops, answers, proposed=None,
+def run_math_set(terms, ops=None, answers=None, proposed=None,
                  clock = None,
                  mathlog = None,
                  minProblemTime = 2000,
@@ -169,13 +965,26 @@ def run_math_set(terms, ops, answers, proposed=None,
                  numberDuration = 800,
                  numberISI = 0,
                  probISI = 500,
-                 probJitter = 0):
+                 probJitter = 0,
+                 logPrep = False,
+                 logMode = None,
+                 binlog = None,
+                 backend = None,
+                 timing = None,
+                 schedule = None,
+                 feedback = 'incorrect'):
     """
     Run a math distraction period.
 
     Inputs
     ------
     terms
+        List of the terms of each problem. Alternatively, an
+        iterable problem source (e.g. prep_math.iter_math_problems)
+        that gives (terms, ops, answer, proposed) for each problem;
+        problems are then taken from the source only as they are
+        needed, and ops, answers, and proposed are ignored. May also
+        be a prep_math.ProblemSet with one set
     ops
     answers
     proposed
@@ -192,7 +1001,12 @@ def run_math_set(terms, ops, answers, proposed=None,
     trialNum
         Number of the current trial (just used for logging)
     tf_bc
-        Button choose for true/false responses
+        Button choose for true/false responses. If None, the
+        participant types the answer and presses ENTER or RETURN to
+        commit it (see KeyBuffer). Only the answer field is redrawn
+        after each key. Each key is logged (KEY) with its RT, and
+        the typed answer is logged (ENTRY) with the RT to the first
+        key and the RT to the commit
     tfKeys
         Tuple of Key objects, where tfKeys[0] gives the "true"
         key, and tfKeys[1] gives the "false" key
@@ -213,31 +1027,90 @@ def run_math_set(terms, ops, answers, proposed=None,
         Length (in ms) of the pause between problems
     probJitter
         Maximum jitter (in ms) to add to the problem ISI.
+    logPrep
+        If true, log how long it took to prepare each problem, and
+        how much time was left before its onset once it was ready.
+        Preparation is done during the ISI, so a negative slack
+        means preparation delayed the onset
+    logMode
+        If None, records are written to mathlog as they are logged.
+        If 'set', records are queued in memory and written at the
+        end of the set; if 'thread', they are written by a
+        background thread. Queued records are always written before
+        returning, including when the set is interrupted (e.g. by
+        the escape-break exit). mathlog may also be a MathLogBuffer,
+        which is flushed at the end of the set
+    binlog
+        math_binlog.BinaryMathLog to write fixed-size records of each
+        event to, in addition to mathlog
+    backend
+        Source of the video, audio, and keyboard tracks, clock, text,
+        and sounds. Default is a PyEPLBackend using the current PyEPL
+        tracks; see headless.py for running without a display
+    timing
+        TimingRecorder to record the intended and actual onset of
+        every term, answer, ISI, and fixation in the set. It is reset
+        at the start of the set, and a summary is logged before the
+        end of the set (see TimingRecorder.summary)
+    schedule
+        DeadlineSchedule to present problems against absolute
+        deadlines. The jitter for every problem ISI is drawn at the
+        start of the set, and the onset of each problem, term, and
+        proposed answer is scheduled from the end of the previous
+        problem, so that overruns do not add up. The schedule of
+        each problem is logged. If None, each ISI and term is
+        timed with a delay from the end of the last one
+    feedback
+        Problems to give a feedback beep for: 'incorrect' (default),
+        'correct', 'both', or 'none'. Beeps are taken from
+        backend.beep_cache, so they are synthesized only once per
+        session. Each beep is played without waiting for it to
+        finish, and its start time is logged (BEEP)
     """
 
     # set up tracks
-    v = display.VideoTrack.lastInstance()  
-    a = sound.AudioTrack.lastInstance()
-    k = keyboard.KeyTrack.lastInstance()
+    if backend is None:
+        backend = PyEPLBackend()
+    v = backend.video
+    a = backend.audio
+    k = backend.keyboard
     if mathlog is None:
-        mathlog = LogTrack('math_distract')
+        mathlog = backend.LogTrack('math_distract')
+    if logMode is not None:
+        if logMode not in ('set', 'thread'):
+            raise ValueError('Unknown logMode: %r' % (logMode,))
+        setLog = MathLogBuffer(mathlog, background=(logMode == 'thread'))
+        mathlog = setLog
+    else:
+        setLog = None
 
-    # beeps for feedback
-    correctBeep = sound.Beep(correctBeepFreq, correctBeepDur,
-                             correctBeepRF)
-    incorrectBeep = sound.Beep(incorrectBeepFreq, incorrectBeepDur,
-                               incorrectBeepRF)
+    # beeps for feedback, synthesized once and reused by later sets
+    if feedback not in FEEDBACK_MODES:
+        raise ValueError('Unknown feedback mode: %r' % (feedback,))
+    feedbackFor = FEEDBACK_MODES[feedback]
+    beeps = {}
+    if 1 in feedbackFor:
+        beeps[1] = backend.beep_cache.get(correctBeepFreq, correctBeepDur,
+                                          correctBeepRF)
+    if 0 in feedbackFor:
+        beeps[0] = backend.beep_cache.get(incorrectBeepFreq,
+                                          incorrectBeepDur, incorrectBeepRF)
 
     # start timing
     if clock is None:
-        clock = exputils.PresentationClock()
+        clock = backend.Clock()
     start_time = clock.get()
+    if timing is not None:
+        timing.reset()
     
     if trialNum is None:
         trialNum = -1
 
     # log the time on the clock after fixation, etc.
-    mathlog.logMessage('MATH START\t%d\t\t\t\t\t' % (trialNum), start_time)
+    _log_record(mathlog, 'MATH START\t%d\t\t\t\t\t', (trialNum,),
+                start_time)
+    if binlog is not None:
+        binlog.write('MATH START', trialNum, start_time)
 
     # set response type
     if not tf_bc is None:
@@ -257,99 +1130,174 @@ def run_math_set(terms, ops, answers, proposed=None,
                                '5','6','7','8','9','-','RETURN',
                                '[0]','[1]','[2]','[3]','[4]',
                                '[5]','[6]','[7]','[8]','[9]',
-                               '[-]','ENTER','[*]')
+                               '[-]','ENTER','[*]','BACKSPACE')
+
+    # get problems one at a time from the source
+    if isinstance(terms, prep_math.ProblemSet):
+        if len(terms) != 1:
+            raise ValueError('ProblemSet must contain exactly one set.')
+        problems = terms.iter_problems()
+    elif ops is None:
+        problems = iter(terms)
+    else:
+        if proposed is None:
+            proposed = [None] * len(terms)
+        problems = iter(zip(terms, ops, answers, proposed))
+    problem = next(problems, None)
 
     maxDistracterLimit = int(maxDistracterLimit)
-    if presentSeq:
-        # adjust the minumum time required for a problem to be presented
-        numVars = len(terms[0])
-        minProblemTime += (numberDuration + numberISI) * (numVars + 1)
+    if problem is not None:
+        numVars = len(problem[0])
+    else:
+        numVars = None
 
+    if schedule is not None:
+        # draw the jitter for the most problems that could fit
+        if numVars is not None:
+            nPlan = prep_math.max_problems(maxDistracterLimit,
+                minProblemTime, numVars, presentSeq, numberDuration,
+                numberISI, probISI, probJitter, 1, showEquals)
+        else:
+            nPlan = 0
+        schedule.reset(nPlan, probJitter)
+
+    # adjust the minimum time required for a problem to be presented
+    # (prep_math.max_problems uses the same rule to plan set sizes)
     endTime = start_time + maxDistracterLimit
-    if (endTime - clock.get()) > (minProblemTime + probISI + probJitter):
-        # we'll present at least one problem; so add the maximum ISI to
-        # minProblemTime, since it will apply to all problems after
-        # the first
-        minProblemTime += probISI + probJitter
+    minProblemTime = prep_math.admission_threshold(endTime - clock.get(),
+        minProblemTime, numVars, presentSeq, numberDuration, numberISI,
+        probISI, probJitter)
     
-    # do problems until there isn't time left to present another one
-    curProb = 0
-    nCorrect = 0
-    nProblems = 0
-    probTimes = []
-    while ((endTime - clock.get()) > minProblemTime):
-        if curProb > (len(terms) - 1):
-            # we have run out of problems!
-            print 'Warning: insufficient problems for distraction period'
-            break
-
-        if curProb > 0:
-            # pause briefly before displaying the next problem
-            clock.delay(probISI, probJitter)
+    try:
+        # do problems until there isn't time left to present another one
+        curProb = 0
+        nCorrect = 0
+        nProblems = 0
+        probTimes = []
+        while ((endTime - clock.get()) > minProblemTime):
+            if curProb > 0:
+                problem = next(problems, None)
+            if problem is None:
+                # we have run out of problems!
+                print('Warning: insufficient problems for distraction period')
+                break
+
+            curTerms, curOps, curAnswer, curProposed = problem
+            if schedule is not None:
+                # wait until the scheduled onset of the problem
+                nItems = len(curTerms)
+                if showEquals:
+                    nItems += 1
+                plan = schedule.plan(clock.get(), nItems, presentSeq,
+                                     numberDuration, numberISI, probISI)
+                _wait(clock, 0, plan['onset'])
+                deadlines = plan['events']
+                _log_record(mathlog, 'SCHED\t%d\t%d\t%d\t%d\t\t',
+                            (trialNum, curProb, plan['jitter'],
+                             deadlines[-1][1]), plan['onset'])
+            else:
+                deadlines = None
+                if curProb > 0:
+                    # pause briefly before displaying the next problem
+                    clock.delay(probISI, probJitter)
             
-        if tfProblems:
-            curProposed = proposed[curProb]
-        else:
-            curProposed = None
+            if not tfProblems:
+                curProposed = None
+
+            # prepare the problem while the ISI runs, so that its onset
+            # only requires showing the text
+            prepStart = backend.now()
+            prepared = prepare_problem(curTerms, curOps, curAnswer,
+                                       textSize, tfProblems, tfKeys,
+                                       curProposed, presentSeq, showEquals,
+                                       backend.text_cache)
+            prepEnd = backend.now()
+            if logPrep:
+                _log_record(mathlog, 'PREP\t%d\t%d\t%d\t\t\t',
+                            (trialNum, prepEnd - prepStart,
+                             clock.get() - prepEnd), prepStart)
         
-        # present the problem, record a response
-        isCorrect, timeout, probstart = run_problem(terms[curProb], 
-            ops[curProb], answers[curProb], v, clock, mathlog,
-            textSize, endTime, ans_but, trialNum=trialNum,
-            numberDuration=numberDuration,
-            numberISI=numberISI,
-            tfProblems=tfProblems, tfKeys=tfKeys,
-            proposed=curProposed, presentSeq=presentSeq,
-            showEquals=showEquals)
-        probTimes.append(probstart)
-
-        # the problem has to have been presented at least
-        nProblems += 1
-
-        # give feedback (only if we did not run out of time)
-        if not timeout:
-            if isCorrect:
-                # correct beep
-                #pTime = a.play(correctBeep, t=clock, doDelay=False)
-                # need to add an option to specify whether they want
-                # beeps or not
-                pass
-            else:
-                # incorrect beep
-                pTime = a.play(incorrectBeep, t=clock, doDelay=False)
-        curProb += 1
-        if not timeout and isCorrect:
-            nCorrect += 1
-
-    # we did not have enough time to present another problem, so we're
-    # done with the math
-    remaining = endTime - clock.get()
-    if (fixation is not None) and (remaining > (probISI + probJitter)):
-        # if there is time, show a blank screen just like we would if
-        # there were still math problems; the participant will still
-        # be bracing for a new problem, and won't relax until the
-        # fixation appears
-        clock.delay(probISI, probJitter)
+            # present the problem, record a response
+            isCorrect, timeout, probstart = run_problem(curTerms,
+                curOps, curAnswer, v, clock, mathlog,
+                textSize, endTime, ans_but, trialNum=trialNum,
+                numberDuration=numberDuration,
+                numberISI=numberISI,
+                tfProblems=tfProblems, tfKeys=tfKeys,
+                proposed=curProposed, presentSeq=presentSeq,
+                showEquals=showEquals, prepared=prepared,
+                binlog=binlog, probNum=curProb, backend=backend,
+                timing=timing, deadlines=deadlines)
+            probTimes.append(probstart)
+
+            # the problem has to have been presented at least
+            nProblems += 1
+
+            # give feedback (only if we did not run out of time); the
+            # beep plays while the next ISI runs
+            if not timeout and isCorrect in beeps:
+                pTime = a.play(beeps[isCorrect], t=clock, doDelay=False)
+                _log_record(mathlog, 'BEEP\t%d\t%d\t%d\t\t\t',
+                            (trialNum, curProb, isCorrect), pTime)
+                if binlog is not None:
+                    binlog.write('BEEP', trialNum, pTime, item=curProb,
+                                 correct=isCorrect)
+            curProb += 1
+            if not timeout and isCorrect:
+                nCorrect += 1
+
+        # we did not have enough time to present another problem, so we're
+        # done with the math
         remaining = endTime - clock.get()
+        if (fixation is not None) and (remaining > (probISI + probJitter)):
+            # if there is time, show a blank screen just like we would if
+            # there were still math problems; the participant will still
+            # be bracing for a new problem, and won't relax until the
+            # fixation appears
+            clock.delay(probISI, probJitter)
+            remaining = endTime - clock.get()
     
-    if remaining > 0:
-        if fixation is not None:
-            # show fixation for the remaining time, log the start of a
-            # period where the participant is just resting and not
-            # doing problems
-            fix = v.showCentered(fixation)
-            ts = v.updateScreen(clock)
-            clock.delay(remaining)
-
-            mathlog.logMessage('REST\t%d\t\t\t\t\t' % (trialNum), ts)
+        if remaining > 0:
+            if fixation is not None:
+                # show fixation for the remaining time, log the start of a
+                # period where the participant is just resting and not
+                # doing problems
+                fix = v.showCentered(fixation)
+                ts = _update_screen(v, clock, timing, 'FIX')
+                clock.delay(remaining)
+
+                _log_record(mathlog, 'REST\t%d\t\t\t\t\t', (trialNum,), ts)
+                if binlog is not None:
+                    binlog.write('REST', trialNum, ts)
+            else:
+                fix = None
+                clock.delay(remaining)
         else:
             fix = None
-            clock.delay(remaining)
-    else:
-        fix = None
 
-    # log the time on the clock after fixation, etc.
-    mathlog.logMessage('MATH END\t%d\t\t\t\t\t' % (trialNum), clock.get())
+        if timing is not None:
+            # log onset errors (ms), late frames, and whether timing
+            # drifted beyond tolerance
+            t = timing.summary()
+            _log_record(mathlog, 'TIMING\t%d\t%d\t%.1f\t%d\t%d\t%d\t%s',
+                        (trialNum, t['n_onsets'], t['mean_error'],
+                         t['max_error'], t['n_late'], t['drifted'],
+                         ','.join(str(x) for x in t['latency_counts'])),
+                        clock.get())
+
+        # log the time on the clock after fixation, etc.
+        _log_record(mathlog, 'MATH END\t%d\t\t\t\t\t', (trialNum,),
+                    clock.get())
+        if binlog is not None:
+            binlog.write('MATH END', trialNum, clock.get())
+    finally:
+        # make sure that no queued records are lost
+        if setLog is not None:
+            setLog.close()
+        elif isinstance(mathlog, MathLogBuffer):
+            mathlog.flush()
+        if binlog is not None:
+            binlog.flush()
 
     return nCorrect, nProblems, start_time, probTimes, fix
  
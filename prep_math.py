@@ -1,10 +1,76 @@
 
-import random, math, numpy
+import os, math, operator, itertools, hashlib, struct, zlib, base64
+import numpy
+from collections import OrderedDict
+
+# operator symbols, in the order of the integer codes used to
+# represent operators in arrays
+OP_SYMBOLS = ('+', '-', '*', '/')
+
+class LRUCache(object):
+    """
+    Mapping with a maximum size that discards the least recently
+    used items.
+
+    Inputs
+    ------
+    maxsize : int
+        Maximum number of items to keep.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Get an item, marking it as recently used."""
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            # remove the oldest item
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Remove all items and reset the hit counts."""
+        self._data.clear()
+        self.hits = 0
+        self.misses = 0
+
+# functions and precedence for each operator
+OPERATORS = {'+': (operator.add, 1),
+             '-': (operator.sub, 1),
+             '*': (operator.mul, 2),
+             '/': (operator.truediv, 2)}
+
+# answers and problem strings for recently evaluated problems
+problem_cache = LRUCache(10000)
 
 def eval_problem(terms, ops):
     """
     Construct a problem string and evaluate the answer.
 
+    Multiplication and division take precedence over addition and
+    subtraction; division is true division. Results are cached, so
+    repeated problems are not reevaluated.
+
     Inputs
     ------
     terms : tuple
@@ -24,6 +90,11 @@ def eval_problem(terms, ops):
         The left-hand side of the equation in string form.
     """
 
+    key = (tuple(terms), tuple(ops))
+    result = problem_cache.get(key)
+    if result is not None:
+        return result
+
     # generate the problem text
     prob_str = ''
     for i,x in enumerate(terms):
@@ -34,13 +105,100 @@ def eval_problem(terms, ops):
         # following number
         prob_str += str(x)
 
-    # solve the problem
-    answer = eval(prob_str)
+    # solve the problem, applying '*' and '/' before '+' and '-'
+    total = 0
+    group_op = operator.add
+    group = terms[0]
+    for op, x in zip(ops, terms[1:]):
+        try:
+            func, precedence = OPERATORS[op]
+        except KeyError:
+            raise ValueError("Unknown operator: %r" % (op,))
+        
+        if precedence > 1:
+            group = func(group, x)
+        else:
+            total = group_op(total, group)
+            group_op = func
+            group = x
+    answer = group_op(total, group)
+
+    result = (answer, prob_str)
+    problem_cache[key] = result
+    return result
+
+def random_seed():
+    """
+    Get a new 128-bit seed from the operating system.
+    """
+    return int(base64.b16encode(os.urandom(16)), 16)
+
+def _seed_key(seed):
+    """
+    Convert a seed to a tuple of ints.
+    """
+    if isinstance(seed, tuple):
+        return seed
+    return (int(seed),)
+
+def get_rng(seed=None):
+    """
+    Get a random number generator.
+
+    Inputs
+    ------
+    seed : None, int, tuple of ints, or numpy.random.RandomState
+        If a RandomState, it is returned unchanged. Otherwise, it is
+        hashed to seed a new RandomState; if None, the seed is taken
+        from the operating system.
+
+    Outputs
+    -------
+    rng : numpy.random.RandomState
+    """
+
+    if isinstance(seed, numpy.random.RandomState):
+        return seed
+    if seed is None:
+        return numpy.random.RandomState()
 
-    return answer, prob_str
+    # hash the seed to 8 uint32 words, so that seeds that differ only
+    # in their last index give unrelated streams
+    text = ' '.join(['%d' % x for x in _seed_key(seed)])
+    digest = hashlib.sha256(text.encode('ascii')).digest()
+    return numpy.random.RandomState(numpy.frombuffer(digest, '<u4'))
+
+def child_seed(seed, index):
+    """
+    Derive an independent seed for one of several random streams.
+
+    The child of a seed with a given index is always the same, and
+    does not depend on which other children have been derived, so
+    streams can be regenerated in any order. A child is the parent
+    seed with index appended, so children can be split again.
+
+    Inputs
+    ------
+    seed : int, tuple of ints, or numpy.random.RandomState
+        Parent seed. A RandomState cannot be split, so it is returned
+        unchanged and its draws are shared between streams. If None,
+        a new seed is taken from the operating system.
+    index : int
+        Index of the child stream.
+
+    Outputs
+    -------
+    child : tuple of ints or numpy.random.RandomState
+    """
+
+    if isinstance(seed, numpy.random.RandomState):
+        return seed
+    if seed is None:
+        seed = random_seed()
+    return _seed_key(seed) + (int(index),)
 
 def gen_problem(n_terms, possible_terms, possible_ops,
-                unique_terms=False):
+                unique_terms=False, rng=None):
     """
     Generate a random math problem.
 
@@ -50,33 +208,972 @@ def gen_problem(n_terms, possible_terms, possible_ops,
     possible_terms : list of numbers
     possible_ops : list of strs
     unique_terms : bool
+    rng : seed or numpy.random.RandomState
+        Source of random numbers (see get_rng).
 
     Outputs
     -------
     terms : list
     ops : list
     """
+
+    rng = get_rng(rng)
+    possible_terms = list(possible_terms)
+    possible_ops = list(possible_ops)
+    
+    # choose the terms; sample without replacement if they must be
+    # unique
+    ind = rng.choice(len(possible_terms), n_terms,
+                     replace=not unique_terms)
+    terms = [possible_terms[i] for i in ind]
+
+    # sample with replacement from possible operators
+    ind = rng.randint(0, len(possible_ops), n_terms - 1)
+    ops = [possible_ops[i] for i in ind]
+
+    return terms, ops
+
+def encode_ops(ops):
+    """
+    Convert operator symbols to integer codes.
+
+    Inputs
+    ------
+    ops : list of strs
+        Operator symbols; each must be one of OP_SYMBOLS.
+
+    Outputs
+    -------
+    op_codes : numpy.ndarray
+        Index of each operator in OP_SYMBOLS.
+    """
+    
+    try:
+        return numpy.array([OP_SYMBOLS.index(x) for x in ops],
+                           dtype=numpy.uint8)
+    except ValueError:
+        raise ValueError("Operators must be in %r." % (OP_SYMBOLS,))
+
+def decode_ops(op_codes):
+    """
+    Convert an array of operator codes to lists of symbols.
+    """
+    
+    return numpy.array(OP_SYMBOLS)[numpy.asarray(op_codes)].tolist()
+
+def gen_problem_batch(n_problems, n_terms, possible_terms, possible_ops,
+                      unique_terms=False, rng=None):
+    """
+    Generate many random math problems at once.
+
+    Inputs
+    ------
+    n_problems : int
+    n_terms : int
+    possible_terms : list of numbers
+    possible_ops : list of strs
+    unique_terms : bool
+    rng : seed or numpy.random.RandomState
+
+    Outputs
+    -------
+    terms : numpy.ndarray
+        [n_problems x n_terms] array of terms.
+    op_codes : numpy.ndarray
+        [n_problems x n_terms-1] array of operator codes (see
+        OP_SYMBOLS).
+    """
+
+    rng = get_rng(rng)
+    possible_terms = numpy.asarray(possible_terms)
+    possible_codes = encode_ops(possible_ops)
     
     # choose the terms
     if unique_terms:
-        # sample without replacement
-        terms = random.sample(possible_terms, n_terms)
+        if n_terms > len(possible_terms):
+            raise ValueError("Cannot draw %d unique terms from %d "
+                             "possible terms." %
+                             (n_terms, len(possible_terms)))
+        
+        # sample without replacement: the order of random keys gives
+        # a random permutation of the possible terms for each problem
+        keys = rng.random_sample((n_problems, len(possible_terms)))
+        ind = numpy.argsort(keys, axis=1)[:,:n_terms]
     else:
         # sample with replacement
-        terms = []
-        for i in range(n_terms):
-            terms.extend(random.sample(possible_terms, 1))
+        ind = rng.randint(0, len(possible_terms),
+                           (n_problems, n_terms))
+    terms = possible_terms[ind]
 
     # sample with replacement from possible operators
-    ops = []
-    for i in range(n_terms - 1):
-        ops.extend(random.sample(possible_ops, 1))
+    ind = rng.randint(0, len(possible_codes),
+                       (n_problems, n_terms - 1))
+    op_codes = possible_codes[ind]
 
-    return terms, ops
+    return terms, op_codes
+
+def eval_problem_batch(terms, op_codes):
+    """
+    Evaluate the answers to many problems at once.
+
+    Multiplication and division take precedence over addition and
+    subtraction. Division is true division, so any problems
+    including division produce float answers.
+
+    Inputs
+    ------
+    terms : numpy.ndarray
+        [n_problems x n_terms] array of terms.
+    op_codes : numpy.ndarray
+        [n_problems x n_terms-1] array of operator codes.
+
+    Outputs
+    -------
+    answers : numpy.ndarray
+        Answer to each problem.
+    """
+
+    terms = numpy.asarray(terms)
+    op_codes = numpy.asarray(op_codes)
+    if numpy.any(op_codes == OP_SYMBOLS.index('/')):
+        terms = terms.astype(float)
+
+    # fold the terms left to right. Runs of '*' and '/' are combined
+    # into a group before the group is added to (or subtracted from)
+    # the total
+    total = numpy.zeros(terms.shape[0], dtype=terms.dtype)
+    group = terms[:,0].copy()
+    sign = numpy.ones(terms.shape[0], dtype=terms.dtype)
+    for i in range(1, terms.shape[1]):
+        code = op_codes[:,i-1]
+        x = terms[:,i]
+
+        # additive operators finish the current group
+        additive = code <= 1
+        total[additive] += sign[additive] * group[additive]
+        sign[additive] = numpy.where(code[additive] == 1, -1, 1)
+        group[additive] = x[additive]
+
+        # multiplicative operators extend it
+        mult = code == 2
+        group[mult] = group[mult] * x[mult]
+        div = code == 3
+        if numpy.any(div):
+            group[div] = group[div] / x[div]
+    total += sign * group
+
+    return total
+
+def _prefix_values(terms, op_codes):
+    """
+    Values of each problem after each of its terms.
+
+    Outputs
+    -------
+    values : list of numpy.ndarrays
+        values[k] is the value of the first k+1 terms of each problem.
+    """
+
+    return [eval_problem_batch(terms[:,:k+1], op_codes[:,:k])
+            for k in range(terms.shape[1])]
+
+class Constraint(object):
+    """
+    Constraint on the problems that may be generated.
+
+    Constraints are evaluated over whole batches of candidate
+    problems at once. Subclasses define mask, which returns a
+    boolean array that is true for problems that are allowed. The
+    repr of a constraint identifies it (e.g. for caching filtered
+    problem spaces), so it should include all of its parameters.
+    """
+
+    def mask(self, terms, op_codes, answers):
+        """
+        Find allowed problems.
+
+        Inputs
+        ------
+        terms : numpy.ndarray
+            [n_problems x n_terms] array of terms.
+        op_codes : numpy.ndarray
+            [n_problems x n_terms-1] array of operator codes.
+        answers : numpy.ndarray
+            Answer to each problem.
+
+        Outputs
+        -------
+        allowed : numpy.ndarray
+            Boolean array that is true for allowed problems.
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '%s()' % type(self).__name__
+
+class AnswerRange(Constraint):
+    """
+    Answers must be within [min_answer, max_answer].
+
+    Either limit may be None to leave that side open.
+    """
+
+    def __init__(self, min_answer=None, max_answer=None):
+        self.min_answer = min_answer
+        self.max_answer = max_answer
+
+    def mask(self, terms, op_codes, answers):
+        allowed = numpy.ones(len(answers), dtype=bool)
+        if self.min_answer is not None:
+            allowed &= answers >= self.min_answer
+        if self.max_answer is not None:
+            allowed &= answers <= self.max_answer
+        return allowed
+
+    def __repr__(self):
+        return 'AnswerRange(%r, %r)' % (self.min_answer, self.max_answer)
+
+class NonNegative(Constraint):
+    """
+    Intermediate results must not be negative.
+
+    Intermediate results are the values of the first two terms, the
+    first three terms, etc., not including the whole problem.
+    """
+
+    def mask(self, terms, op_codes, answers):
+        allowed = numpy.ones(len(answers), dtype=bool)
+        for values in _prefix_values(terms, op_codes)[1:-1]:
+            allowed &= values >= 0
+        return allowed
+
+class NoCarry(Constraint):
+    """
+    No carrying or borrowing.
+
+    Each term that is added to (or subtracted from) the result so far,
+    working left to right, must not require carrying (or borrowing)
+    in any digit. Problems with negative or fractional values are not
+    allowed. Steps with multiplication or division are not checked.
+    """
+
+    def mask(self, terms, op_codes, answers):
+        allowed = numpy.ones(len(answers), dtype=bool)
+        values = _prefix_values(terms, op_codes)
+        for i in range(1, terms.shape[1]):
+            a = values[i-1]
+            b = terms[:,i]
+            code = op_codes[:,i-1]
+            if a.dtype.kind == 'f':
+                whole = a == numpy.floor(a)
+                allowed &= whole
+                a = numpy.where(whole, a, 0).astype(int)
+            allowed &= (a >= 0) & (b >= 0)
+            a = numpy.abs(a)
+            b = numpy.abs(b)
+            plus = code == OP_SYMBOLS.index('+')
+            minus = code == OP_SYMBOLS.index('-')
+            while numpy.any((a > 0) | (b > 0)):
+                da = a % 10
+                db = b % 10
+                allowed &= ~(plus & (da + db >= 10))
+                allowed &= ~(minus & (da < db))
+                a = a // 10
+                b = b // 10
+        return allowed
+
+def make_constraints(min_answer=None, max_answer=None, non_negative=False,
+                     no_carry=False):
+    """
+    Create a list of constraints from options.
+
+    Outputs
+    -------
+    constraints : list of Constraints
+    """
+
+    constraints = []
+    if min_answer is not None or max_answer is not None:
+        constraints.append(AnswerRange(min_answer, max_answer))
+    if non_negative:
+        constraints.append(NonNegative())
+    if no_carry:
+        constraints.append(NoCarry())
+    return constraints
+
+def apply_constraints(constraints, terms, op_codes, answers):
+    """
+    Find problems that satisfy all constraints.
+
+    Outputs
+    -------
+    allowed : numpy.ndarray
+        Boolean array that is true for allowed problems.
+    """
+
+    allowed = numpy.ones(len(answers), dtype=bool)
+    for constraint in constraints:
+        allowed &= constraint.mask(terms, op_codes, answers)
+    return allowed
+
+class ProblemsExhausted(ValueError):
+    """
+    Raised when there are no unused problems left to draw.
+    """
+    pass
+
+def problem_keys(terms, op_codes, proposed=None):
+    """
+    Get canonical keys for problems.
+
+    Problems with the same terms and operators (and proposed answer,
+    if given) have the same key, so keys can be used to look up
+    problems in a set or dict.
+
+    Inputs
+    ------
+    terms : array_like
+        [n_problems x n_terms] array of terms.
+    op_codes : array_like
+        [n_problems x n_terms-1] array of operator codes.
+    proposed : array_like
+        Proposed answer for each problem.
+
+    Outputs
+    -------
+    keys : list of bytes
+    """
+
+    terms = numpy.asarray(terms)
+    op_codes = numpy.asarray(op_codes).reshape(terms.shape[0],
+                                               terms.shape[1] - 1)
+    parts = [terms.astype('<i4'), op_codes.astype('<i4')]
+    if proposed is not None:
+        parts.append(numpy.asarray(proposed).astype('<i4')[:,None])
+    rows = numpy.ascontiguousarray(numpy.hstack(parts))
+    dtype = numpy.dtype((numpy.void, rows.dtype.itemsize * rows.shape[1]))
+    return [bytes(x) for x in rows.view(dtype).ravel().tolist()]
+
+class ProblemRegistry(object):
+    """
+    Hashed index of problems that have already been used.
+
+    Passing a registry when generating problems ensures that each
+    problem is only used once, for as long as the registry is kept
+    (e.g. across the sets in a session, or across the sessions of a
+    subject). Membership checks take constant time, so generation
+    time does not grow with the number of problems used.
+
+    Inputs
+    ------
+    pairs : bool
+        If true, each pairing of a problem with a proposed answer is
+        only used once, but a problem may be reused with a different
+        proposed answer.
+    """
+
+    def __init__(self, pairs=False):
+        self.pairs = pairs
+        self._keys = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def add(self, keys):
+        """Mark problems as used."""
+        self._keys.update(keys)
+
+    def discard(self, keys):
+        """Mark problems as unused."""
+        self._keys.difference_update(keys)
+
+    def used(self, keys):
+        """
+        Find used problems.
+
+        Outputs
+        -------
+        used : numpy.ndarray
+            Boolean array that is true for keys in the registry.
+        """
+        keys_set = self._keys
+        return numpy.array([k in keys_set for k in keys], dtype=bool)
+
+    def save(self, filename):
+        """Save the registry to a NumPy .npz file."""
+        groups = {}
+        for key in self._keys:
+            groups.setdefault(len(key), []).append(key)
+        arrays = {}
+        for size, keys in groups.items():
+            arrays['k%d' % size] = numpy.frombuffer(b''.join(keys),
+                dtype='<i4').reshape(len(keys), size // 4)
+        tmp = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            numpy.savez(f, pairs=self.pairs, **arrays)
+        os.rename(tmp, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a registry saved to a NumPy .npz file."""
+        with numpy.load(filename) as data:
+            registry = cls(bool(data['pairs']))
+            for name in data.files:
+                if name.startswith('k'):
+                    rows = numpy.ascontiguousarray(data[name], dtype='<i4')
+                    registry.add(row.tobytes() for row in rows)
+        return registry
+
+def make_registry(unique=None):
+    """
+    Create a registry for keeping problems unique.
+
+    Inputs
+    ------
+    unique : {None, 'problem', 'pair'}
+        What must not be reused: problems, or pairings of problems
+        and proposed answers. If None, no registry is needed.
+
+    Outputs
+    -------
+    registry : ProblemRegistry or None
+    """
+
+    if unique is None:
+        return None
+    elif unique not in ('problem', 'pair'):
+        raise ValueError("Unknown uniqueness option: %r" % (unique,))
+    return ProblemRegistry(unique == 'pair')
+
+def _too_close(answers, prev_answers, min_diff=None):
+    """
+    Find answers that repeat (or are within min_diff of) the previous
+    answer.
+    """
+
+    if min_diff is None:
+        return answers == prev_answers
+    return numpy.abs(answers - prev_answers) < min_diff
+
+# largest number of candidate problems to draw at once
+MAX_BATCH = 1000000
+
+def _gen_valid_batch(n_problems, n_terms, possible_terms, possible_ops,
+                     unique_terms=False, constraints=None, rng=None,
+                     max_rounds=1000, registry=None):
+    """
+    Generate problems that satisfy a set of constraints.
+
+    Candidates are drawn in batches, sized using the fraction of
+    candidates accepted so far, so that few rounds are needed even
+    when most candidates are rejected. If registry is given, only
+    unused problems are accepted, and the problems that are returned
+    are added to it.
+    """
+
+    rng = get_rng(rng)
+    if not constraints and registry is None:
+        terms, op_codes = gen_problem_batch(n_problems, n_terms,
+                                            possible_terms, possible_ops,
+                                            unique_terms, rng)
+        return terms, op_codes, eval_problem_batch(terms, op_codes)
+
+    parts = []
+    keys = []
+    seen = set()
+    n_found = 0
+    n_drawn = 0
+    for i in range(max_rounds):
+        if n_found >= n_problems:
+            break
+        rate = float(n_found + 1) / (n_drawn + 1)
+        n_draw = int(min(max((n_problems - n_found) / rate * 1.2, 16),
+                         MAX_BATCH))
+        terms, op_codes = gen_problem_batch(n_draw, n_terms,
+                                            possible_terms, possible_ops,
+                                            unique_terms, rng)
+        answers = eval_problem_batch(terms, op_codes)
+        allowed = apply_constraints(constraints or [], terms, op_codes,
+                                    answers)
+        if n_draw == MAX_BATCH and not numpy.any(allowed):
+            raise ValueError("No problems satisfy the constraints in %d "
+                             "candidates." % MAX_BATCH)
+        if registry is not None:
+            # only accept the first draw of each unused problem
+            ind = numpy.nonzero(allowed)[0]
+            for j, key in zip(ind, problem_keys(terms[ind],
+                                                op_codes[ind])):
+                if key in registry or key in seen:
+                    allowed[j] = False
+                else:
+                    seen.add(key)
+                    keys.append(key)
+            if n_draw == MAX_BATCH and not numpy.any(allowed):
+                raise ProblemsExhausted("No unused problems are left.")
+        parts.append((terms[allowed], op_codes[allowed], answers[allowed]))
+        n_found += numpy.count_nonzero(allowed)
+        n_drawn += n_draw
+    else:
+        if n_found < n_problems:
+            if registry is not None:
+                raise ProblemsExhausted("Failed to find enough unused "
+                                        "problems.")
+            raise ValueError("Failed to generate problems that satisfy "
+                             "the constraints.")
+
+    if registry is not None:
+        registry.add(keys[:n_problems])
+    terms = numpy.concatenate([p[0] for p in parts])[:n_problems]
+    op_codes = numpy.concatenate([p[1] for p in parts])[:n_problems]
+    answers = numpy.concatenate([p[2] for p in parts])[:n_problems]
+    return terms, op_codes, answers
+
+def _gen_problem_set_batch(n_problems, n_terms, possible_terms,
+                           possible_ops, unique_terms=False,
+                           exclude_repeats=True, prev_answer=None,
+                           rng=None, max_rounds=1000, constraints=None,
+                           min_diff=None, registry=None):
+    """
+    Generate a set of math problems as arrays.
+
+    Problems that repeat the answer of the preceding problem (or are
+    within min_diff of it) are regenerated together, until no
+    repeats remain. Problems in even and odd positions are
+    regenerated in alternate rounds, so that the problem before each
+    regenerated problem is fixed.
+    """
+
+    rng = get_rng(rng)
+    terms, op_codes, answers = _gen_valid_batch(n_problems, n_terms,
+        possible_terms, possible_ops, unique_terms, constraints, rng,
+        max_rounds, registry)
+    
+    if exclude_repeats or min_diff is not None:
+        for i in range(max_rounds):
+            repeat = numpy.zeros(n_problems, dtype=bool)
+            repeat[1:] = _too_close(answers[1:], answers[:-1], min_diff)
+            if prev_answer is not None and n_problems > 0:
+                repeat[0] = _too_close(answers[0], prev_answer, min_diff)
+            if not numpy.any(repeat):
+                break
+
+            # regenerate problems that repeat the previous answer. Only
+            # problems with the same parity are regenerated at once, so
+            # that their neighbors do not change
+            ind = numpy.nonzero(repeat)[0]
+            ind = ind[ind % 2 == i % 2]
+            if len(ind) == 0:
+                continue
+            new_terms, new_ops, new_answers = _gen_valid_batch(len(ind),
+                n_terms, possible_terms, possible_ops, unique_terms,
+                constraints, rng, max_rounds, registry)
+
+            # keep new problems that fit with the problem before them;
+            # if they are too close to the problem after them, that
+            # problem is regenerated in the next round
+            fits = numpy.ones(len(ind), dtype=bool)
+            first = ind == 0
+            if prev_answer is not None:
+                fits[first] = ~_too_close(new_answers[first], prev_answer,
+                                          min_diff)
+            fits[~first] = ~_too_close(new_answers[~first],
+                                       answers[ind[~first] - 1], min_diff)
+            if registry is not None:
+                # release the problems that are not used
+                registry.discard(problem_keys(new_terms[~fits],
+                                              new_ops[~fits]))
+                registry.discard(problem_keys(terms[ind[fits]],
+                                              op_codes[ind[fits]]))
+            ind = ind[fits]
+            terms[ind] = new_terms[fits]
+            op_codes[ind] = new_ops[fits]
+            answers[ind] = new_answers[fits]
+        else:
+            raise ValueError("Failed to generate a problem set "
+                             "without repeated answers.")
+
+    return terms, op_codes, answers
+
+class ProblemSpace(object):
+    """
+    Index of every possible problem for a configuration.
+
+    Problems are sorted by answer, so that all problems with a given
+    answer occupy a contiguous block of the index. Sampling draws
+    directly from the index; no problems are rejected.
+
+    Inputs
+    ------
+    terms : numpy.ndarray
+        [n_problems x n_terms] array of terms.
+    op_codes : numpy.ndarray
+        [n_problems x n_terms-1] array of operator codes.
+    answers : numpy.ndarray
+        Answer to each problem.
+    """
+
+    def __init__(self, terms, op_codes, answers):
+        order = numpy.argsort(answers, kind='mergesort')
+        self.terms = terms[order]
+        self.op_codes = op_codes[order]
+        self.answers = answers[order]
+
+        # start and size of the block of problems with each answer
+        values, starts, counts = numpy.unique(self.answers,
+                                              return_index=True,
+                                              return_counts=True)
+        self._blocks = dict(zip(values.tolist(),
+                                zip(starts.tolist(), counts.tolist())))
+        self._block_start = numpy.repeat(starts, counts)
+        self._block_size = numpy.repeat(counts, counts)
+        self._keys = None
+
+    @classmethod
+    def build(cls, n_terms, possible_terms, possible_ops,
+              unique_terms=False, max_size=1000000):
+        """
+        Enumerate all problems for a configuration.
+
+        Inputs
+        ------
+        n_terms : int
+        possible_terms : list of numbers
+        possible_ops : list of strs
+        unique_terms : bool
+        max_size : int
+            Maximum number of problems to enumerate. If the space is
+            larger than this, a ValueError is raised.
+        """
+
+        possible_terms = list(possible_terms)
+        possible_codes = encode_ops(possible_ops)
+        n_possible = len(possible_terms)
+        if unique_terms:
+            n_term_sets = 1
+            for i in range(n_terms):
+                n_term_sets *= max(n_possible - i, 0)
+            term_sets = itertools.permutations(possible_terms, n_terms)
+        else:
+            n_term_sets = n_possible ** n_terms
+            term_sets = itertools.product(possible_terms,
+                                          repeat=n_terms)
+        n_op_sets = len(possible_codes) ** (n_terms - 1)
+        if n_term_sets * n_op_sets > max_size:
+            raise ValueError("Problem space has %d problems, which is "
+                             "more than the maximum of %d." %
+                             (n_term_sets * n_op_sets, max_size))
+        if n_term_sets == 0:
+            raise ValueError("Problem space is empty.")
+
+        # every combination of term set and operator set
+        term_sets = numpy.array(list(term_sets))
+        op_sets = numpy.array(list(itertools.product(possible_codes,
+                                                     repeat=n_terms - 1)),
+                              dtype=numpy.uint8)
+        terms = numpy.repeat(term_sets, len(op_sets), axis=0)
+        op_codes = numpy.tile(op_sets, (len(term_sets), 1))
+
+        return cls(terms, op_codes, eval_problem_batch(terms, op_codes))
+
+    def __len__(self):
+        return len(self.answers)
+
+    def answer_block(self, answer):
+        """
+        Get the (start, size) of the block of problems with an answer.
+        """
+        return self._blocks.get(answer, (0, 0))
+
+    def near_block(self, answer, min_diff):
+        """
+        Get the (start, size) of the block of problems with answers
+        within min_diff of an answer.
+        """
+        start = numpy.searchsorted(self.answers, answer - min_diff,
+                                   side='right')
+        end = numpy.searchsorted(self.answers, answer + min_diff,
+                                 side='left')
+        return int(start), int(end - start)
+
+    def keys(self):
+        """Get the key of each problem (see problem_keys)."""
+        if self._keys is None:
+            self._keys = problem_keys(self.terms, self.op_codes)
+        return self._keys
+
+    def exclude(self, registry):
+        """
+        Get the problems in the index that are not in a registry.
+
+        Outputs
+        -------
+        space : ProblemSpace
+        """
+
+        unused = ~registry.used(self.keys())
+        if not numpy.any(unused):
+            raise ProblemsExhausted("No unused problems are left.")
+        return ProblemSpace(self.terms[unused], self.op_codes[unused],
+                            self.answers[unused])
+
+    def filter(self, constraints):
+        """
+        Get the problems in the index that satisfy constraints.
+
+        Outputs
+        -------
+        space : ProblemSpace
+        """
+
+        allowed = apply_constraints(constraints, self.terms,
+                                    self.op_codes, self.answers)
+        if not numpy.any(allowed):
+            raise ValueError("No problems satisfy the constraints.")
+        return ProblemSpace(self.terms[allowed], self.op_codes[allowed],
+                            self.answers[allowed])
+
+    def sample(self, n_problems, exclude_repeats=True, prev_answer=None,
+               rng=None, min_diff=None, unique=False):
+        """
+        Draw random problems from the index.
+
+        Inputs
+        ------
+        n_problems : int
+        exclude_repeats : bool
+            If true, each problem will have a different answer from
+            the problem before it.
+        prev_answer : number
+            Answer of the problem preceding the first one.
+        rng : seed or numpy.random.RandomState
+        min_diff : number
+            If specified, the answers of consecutive problems must
+            differ by at least min_diff.
+        unique : bool
+            If true, each problem is drawn at most once.
+
+        Outputs
+        -------
+        terms : numpy.ndarray
+        op_codes : numpy.ndarray
+        answers : numpy.ndarray
+        """
+
+        rng = get_rng(rng)
+        n_space = len(self)
+        if not exclude_repeats and min_diff is None:
+            if not unique:
+                ind = rng.randint(0, n_space, n_problems)
+            elif n_problems > n_space:
+                raise ProblemsExhausted("Only %d unused problems are "
+                                        "left." % n_space)
+            else:
+                ind = rng.choice(n_space, n_problems, replace=False)
+        else:
+            if min_diff is None:
+                # block of problems with the same answer
+                block_start = self._block_start
+                block_size = self._block_size
+                start, size = self.answer_block(prev_answer)
+            else:
+                # block of problems with answers that are too close
+                block_start = numpy.searchsorted(self.answers,
+                    self.answers - min_diff, side='right')
+                block_size = numpy.searchsorted(self.answers,
+                    self.answers + min_diff, side='left') - block_start
+                if prev_answer is None:
+                    start, size = 0, 0
+                else:
+                    start, size = self.near_block(prev_answer, min_diff)
+            if numpy.any(block_size >= n_space) or size >= n_space:
+                if unique:
+                    raise ProblemsExhausted("Not enough unused problems "
+                                            "with different answers are "
+                                            "left.")
+                raise ValueError("Cannot exclude repeats when all "
+                                 "problems have the same answer (or "
+                                 "answers within min_diff).")
+
+            # draw each problem from the problems outside the block
+            # of the previous answer
+            draws = rng.random_sample(n_problems).tolist()
+            block_start = block_start.tolist()
+            block_size = block_size.tolist()
+            ind = numpy.zeros(n_problems, dtype=int)
+            used = set()
+            for i in range(n_problems):
+                j = int(draws[i] * (n_space - size))
+                if j >= start:
+                    j += size
+                if unique:
+                    if j in used:
+                        j = self._draw_unused(start, size, used, rng)
+                    used.add(j)
+                ind[i] = j
+                start = block_start[j]
+                size = block_size[j]
+            
+        return self.terms[ind], self.op_codes[ind], self.answers[ind]
+
+    def _draw_unused(self, start, size, used, rng, max_tries=100):
+        """
+        Draw a problem that is not in used, outside the block of
+        size problems beginning at start.
+        """
+
+        n_space = len(self)
+        for i in range(max_tries):
+            j = int(rng.random_sample() * (n_space - size))
+            if j >= start:
+                j += size
+            if j not in used:
+                return j
+
+        # most problems have been used; find the ones that are left
+        free = numpy.ones(n_space, dtype=bool)
+        free[list(used)] = False
+        free[start:start + size] = False
+        ind = numpy.nonzero(free)[0]
+        if len(ind) == 0:
+            raise ProblemsExhausted("No unused problems are left.")
+        return int(ind[rng.randint(0, len(ind))])
+
+    def save(self, filename):
+        """Save the index to a NumPy .npz file."""
+        with open(filename, 'wb') as f:
+            numpy.savez(f, terms=self.terms, op_codes=self.op_codes,
+                        answers=self.answers)
+
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved to a NumPy .npz file."""
+        with numpy.load(filename) as data:
+            return cls(data['terms'], data['op_codes'], data['answers'])
+
+# indexes that have been loaded in this session
+_spaces = {}
+
+def load_problem_space(n_terms, possible_terms, possible_ops,
+                       unique_terms=False, cache_dir=None,
+                       constraints=None):
+    """
+    Get the problem space index for a configuration.
+
+    Indexes are built once per configuration. If cache_dir is
+    specified, the index is saved there and reused by later sessions.
+
+    Inputs
+    ------
+    n_terms : int
+    possible_terms : list of numbers
+    possible_ops : list of strs
+    unique_terms : bool
+    cache_dir : str
+    constraints : list of Constraints
+        If specified, the index only includes problems that satisfy
+        the constraints. Filtered indexes are kept for the session.
+
+    Outputs
+    -------
+    space : ProblemSpace
+    """
+
+    key = (n_terms, tuple(possible_terms), tuple(possible_ops),
+           bool(unique_terms))
+    if constraints:
+        subkey = key + tuple(repr(c) for c in constraints)
+        if subkey not in _spaces:
+            space = load_problem_space(n_terms, possible_terms,
+                                       possible_ops, unique_terms,
+                                       cache_dir)
+            _spaces[subkey] = space.filter(constraints)
+        return _spaces[subkey]
+
+    if key in _spaces:
+        return _spaces[key]
+
+    filename = None
+    if cache_dir is not None:
+        name = hashlib.sha1(repr(key).encode('ascii')).hexdigest()
+        filename = os.path.join(cache_dir, 'space_%s.npz' % name[:16])
+
+    if filename is not None and os.path.exists(filename):
+        space = ProblemSpace.load(filename)
+    else:
+        space = ProblemSpace.build(n_terms, possible_terms, possible_ops,
+                                   unique_terms)
+        if filename is not None:
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            # write to a temporary file first, so other sessions never
+            # load a partial index
+            tmp = '%s.%d.tmp' % (filename, os.getpid())
+            space.save(tmp)
+            os.rename(tmp, filename)
+
+    _spaces[key] = space
+    return space
+
+# number of random draws the serial method makes for a problem before
+# searching the problem space for one that is allowed
+MAX_SERIAL_TRIES = 1000
+
+def _draw_from_space(n_terms, possible_terms, possible_ops,
+                     unique_terms, cache_dir, constraints, prev_answer,
+                     exclude_repeats, min_diff, registry, rng,
+                     used=()):
+    """
+    Draw one allowed problem from the enumerated problem space.
+
+    Used by the serial method when random draws keep being rejected,
+    to either find one of the few allowed problems or show that
+    there are none. Problems with keys in used (e.g. problems
+    already in the set) are also excluded.
+    """
+
+    try:
+        load_problem_space(n_terms, possible_terms, possible_ops,
+                           unique_terms, cache_dir)
+    except ValueError:
+        # too many problems to search
+        raise ValueError("Failed to generate a problem that satisfies "
+                         "the constraints in %d tries." %
+                         MAX_SERIAL_TRIES)
+    space = load_problem_space(n_terms, possible_terms, possible_ops,
+                               unique_terms, cache_dir, constraints)
+
+    allowed = numpy.ones(len(space), dtype=bool)
+    if prev_answer is not None and (exclude_repeats or
+                                    min_diff is not None):
+        allowed &= ~_too_close(space.answers, prev_answer, min_diff)
+    if registry is not None:
+        allowed &= ~registry.used(space.keys())
+    if used:
+        allowed &= numpy.array([key not in used for key in space.keys()],
+                               dtype=bool)
+    ind = numpy.nonzero(allowed)[0]
+    if len(ind) == 0:
+        if registry is not None:
+            raise ProblemsExhausted("No unused problems are left.")
+        raise ValueError("No problems satisfy the constraints with an "
+                         "answer different from the previous answer.")
+
+    j = ind[rng.randint(0, len(ind))]
+    return (space.terms[j].tolist(),
+            decode_ops(space.op_codes[j:j + 1])[0])
 
 def gen_problem_set(n_problems, n_terms, possible_terms, 
                     possible_ops, unique_terms=False,
-                    exclude_repeats=True):
+                    exclude_repeats=True, method='serial',
+                    cache_dir=None, prev_answer=None, rng=None,
+                    constraints=None, min_diff=None, registry=None):
     """
     Generate a set of math problems.
 
@@ -88,6 +1185,33 @@ def gen_problem_set(n_problems, n_terms, possible_terms,
     possible_ops : list of strs
     unique_terms : bool
     exclude_repeats : bool
+    method : {'serial', 'batch', 'index'}
+        Method for generating problems. 'serial' generates one
+        problem at a time, searching the problem space if random
+        draws keep being rejected; 'batch' draws all problems as
+        arrays and is much faster for large sets; 'index' enumerates
+        every possible problem and samples from the index, which is
+        fastest when the problem space is small.
+    cache_dir : str
+        Directory for caching problem space indexes (used by the
+        'index' method, and by 'serial' when it searches the problem
+        space).
+    prev_answer : number
+        Answer to the problem preceding this set, if any. Used to
+        exclude repeats when a set continues an earlier one.
+    rng : seed or numpy.random.RandomState
+        Source of random numbers (see get_rng).
+    constraints : list of Constraints
+        Constraints that every problem must satisfy (see
+        make_constraints).
+    min_diff : number
+        If specified, the answers of consecutive problems must differ
+        by at least min_diff.
+    registry : ProblemRegistry
+        If specified, only problems that are not in the registry are
+        used, and each problem is used at most once. The problems in
+        the set are added to the registry. If there are not enough
+        unused problems, ProblemsExhausted is raised.
 
     Outputs
     -------
@@ -95,24 +1219,75 @@ def gen_problem_set(n_problems, n_terms, possible_terms,
     set_ops : list of lists of strs
     set_answers : list of numbers
     """
+
+    rng = get_rng(rng)
+    if method == 'batch':
+        terms, op_codes, answers = _gen_problem_set_batch(n_problems,
+            n_terms, possible_terms, possible_ops, unique_terms,
+            exclude_repeats, prev_answer, rng, constraints=constraints,
+            min_diff=min_diff, registry=registry)
+        return terms.tolist(), decode_ops(op_codes), answers.tolist()
+    elif method == 'index':
+        space = load_problem_space(n_terms, possible_terms,
+                                   possible_ops, unique_terms, cache_dir,
+                                   constraints)
+        if registry is not None:
+            space = space.exclude(registry)
+        terms, op_codes, answers = space.sample(n_problems,
+                                                exclude_repeats,
+                                                prev_answer, rng,
+                                                min_diff,
+                                                registry is not None)
+        if registry is not None:
+            registry.add(problem_keys(terms, op_codes))
+        return terms.tolist(), decode_ops(op_codes), answers.tolist()
+    elif method != 'serial':
+        raise ValueError("Unknown problem generation method: %r" %
+                         (method,))
     
     set_terms = []
     set_ops = []
     set_answers = []
-    prev_answer = None
+    set_keys = []
+    used = set()
     for i in range(n_problems):
         bad_problem = True
+        n_tries = 0
         while bad_problem:
-            # generate a random problem
-            terms, ops = gen_problem(n_terms, possible_terms,
-                                     possible_ops, unique_terms)
+            n_tries += 1
+            if n_tries > MAX_SERIAL_TRIES:
+                # most problems are rejected; search all problems
+                terms, ops = _draw_from_space(n_terms, possible_terms,
+                    possible_ops, unique_terms, cache_dir, constraints,
+                    prev_answer, exclude_repeats, min_diff, registry,
+                    rng, used)
+            else:
+                # generate a random problem
+                terms, ops = gen_problem(n_terms, possible_terms,
+                                         possible_ops, unique_terms, rng)
         
             # get the answer for the problem
             (answer, prob_str) = eval_problem(terms, ops)
-        
-            if exclude_repeats and (answer is prev_answer):
-                # we had the same answer last time; try again
+
+            if constraints and not apply_constraints(constraints,
+                    numpy.array([terms]), encode_ops(ops)[None,:],
+                    numpy.array([answer]))[0]:
+                # the problem is not allowed; try again
                 continue
+        
+            if prev_answer is not None and (exclude_repeats or
+                                            min_diff is not None):
+                if _too_close(answer, prev_answer, min_diff):
+                    # we had the same answer last time; try again
+                    continue
+
+            if registry is not None:
+                key = problem_keys([terms], encode_ops(ops)[None,:])[0]
+                if key in registry or key in used:
+                    # the problem has already been used; try again
+                    continue
+                used.add(key)
+                set_keys.append(key)
             
             # the problem passed all checks
             bad_problem = False
@@ -123,71 +1298,505 @@ def gen_problem_set(n_problems, n_terms, possible_terms,
         set_ops.append(ops)
         set_answers.append(answer)
 
+    # only register problems once the whole set has been generated
+    if registry is not None:
+        registry.add(set_keys)
     return set_terms, set_ops, set_answers
 
-def gen_proposed(answer, dev_vals, dev_probs=None, pos_only=False):
+class ProblemSet(object):
     """
-    Generate a random proposed answer to a problem.
+    Compact, array-backed container for prepared problem sets.
 
     Inputs
     ------
-    answer : number
+    terms : array_like
+        [n_sets x n_problems x n_terms] array of terms.
+    op_codes : array_like
+        [n_sets x n_problems x n_terms-1] array of operator codes
+        (see OP_SYMBOLS).
+    answers : array_like
+        [n_sets x n_problems] array of answers.
+    proposed : array_like
+        [n_sets x n_problems] array of proposed answers, or None if
+        there are no proposed answers.
+
+    Notes
+    -----
+    Indexing with a set number gives a ProblemSet with just that
+    set; indexing with (set, problem) gives the (terms, ops, answer,
+    proposed) for one problem.
+    """
+
+    __slots__ = ('terms', 'op_codes', 'answers', 'proposed')
+
+    # header for the binary format: magic, version, has proposed,
+    # n_sets, n_problems, n_terms
+    _header = struct.Struct('<4sBBIII')
+    _magic = b'MDPS'
+    _version = 1
+
+    def __init__(self, terms, op_codes, answers, proposed=None):
+        self.terms = numpy.asarray(terms, dtype=numpy.int16)
+        self.op_codes = numpy.asarray(op_codes, dtype=numpy.uint8)
+        self.answers = numpy.asarray(answers, dtype=numpy.int32)
+        if proposed is not None:
+            proposed = numpy.asarray(proposed, dtype=numpy.int32)
+        self.proposed = proposed
+
+        n_sets, n_problems, n_terms = self.terms.shape
+        if self.op_codes.shape != (n_sets, n_problems, n_terms - 1):
+            raise ValueError("op_codes does not match the shape of "
+                             "terms.")
+        if self.answers.shape != (n_sets, n_problems):
+            raise ValueError("answers does not match the shape of "
+                             "terms.")
+        if proposed is not None and proposed.shape != self.answers.shape:
+            raise ValueError("proposed does not match the shape of "
+                             "answers.")
+
+    @classmethod
+    def from_lists(cls, terms, ops, answers, proposed=None):
+        """
+        Create a ProblemSet from lists of sets.
+
+        Inputs are lists with one item for each set, where each item
+        is in the format output by prep_math_set. All sets must have
+        the same number of problems and terms, and answers must be
+        integers.
+        """
+
+        terms = numpy.array(terms)
+        ops = numpy.array(ops, dtype=str).reshape(terms.shape[:2] +
+                                                  (terms.shape[2] - 1,))
+        op_codes = numpy.zeros(ops.shape, dtype=numpy.uint8)
+        known = numpy.zeros(ops.shape, dtype=bool)
+        for code, symbol in enumerate(OP_SYMBOLS):
+            match = ops == symbol
+            op_codes[match] = code
+            known |= match
+        if not numpy.all(known):
+            raise ValueError("Operators must be in %r." % (OP_SYMBOLS,))
+
+        answers = numpy.array(answers)
+        if numpy.any(answers != numpy.round(answers)):
+            raise ValueError("ProblemSet only supports integer answers.")
+
+        if proposed is not None and any(x is None for x in proposed):
+            proposed = None
+
+        return cls(terms, op_codes, answers, proposed)
+
+    @property
+    def n_problems(self):
+        """Number of problems in each set."""
+        return self.terms.shape[1]
+
+    def __len__(self):
+        return self.terms.shape[0]
+
+    def __getitem__(self, index):
+        if isinstance(index, tuple):
+            # a single problem
+            set_ind, prob_ind = index
+            if self.proposed is not None:
+                proposed = int(self.proposed[set_ind, prob_ind])
+            else:
+                proposed = None
+            return (self.terms[set_ind, prob_ind].tolist(),
+                    decode_ops(self.op_codes[set_ind, prob_ind]),
+                    int(self.answers[set_ind, prob_ind]), proposed)
+
+        # one or more sets
+        if not isinstance(index, slice):
+            if index < 0:
+                index += len(self)
+            if index < 0 or index >= len(self):
+                raise IndexError("set index out of range")
+            index = slice(index, index + 1)
+        if self.proposed is not None:
+            proposed = self.proposed[index]
+        else:
+            proposed = None
+        return ProblemSet(self.terms[index], self.op_codes[index],
+                          self.answers[index], proposed)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def iter_problems(self, set_index=0):
+        """
+        Generate the (terms, ops, answer, proposed) for each problem
+        in a set.
+        """
+        for i in range(self.n_problems):
+            yield self[set_index, i]
+
+    def to_bytes(self):
+        """Serialize the problem sets to a compact binary string."""
+        n_sets, n_problems, n_terms = self.terms.shape
+        has_proposed = self.proposed is not None
+        parts = [self._header.pack(self._magic, self._version,
+                                   has_proposed, n_sets, n_problems,
+                                   n_terms),
+                 self.terms.astype('<i2').tobytes(),
+                 self.op_codes.tobytes(),
+                 self.answers.astype('<i4').tobytes()]
+        if has_proposed:
+            parts.append(self.proposed.astype('<i4').tobytes())
+        return b''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Create a ProblemSet from the output of to_bytes."""
+        header = cls._header.unpack_from(data)
+        magic, version, has_proposed, n_sets, n_problems, n_terms = header
+        if magic != cls._magic or version != cls._version:
+            raise ValueError("Data are not a serialized ProblemSet.")
+
+        arrays = []
+        offset = cls._header.size
+        for dtype, shape in (('<i2', (n_sets, n_problems, n_terms)),
+                             ('u1', (n_sets, n_problems, n_terms - 1)),
+                             ('<i4', (n_sets, n_problems)),
+                             ('<i4', (n_sets, n_problems))):
+            count = int(numpy.prod(shape))
+            x = numpy.frombuffer(data, dtype=dtype, count=count,
+                                 offset=offset)
+            arrays.append(x.reshape(shape))
+            offset += count * x.itemsize
+            if len(arrays) == 3 and not has_proposed:
+                arrays.append(None)
+                break
+        return cls(*arrays)
+
+    def __getstate__(self):
+        # pickle as compressed, base64-encoded text, which stays
+        # compact even with text pickle protocols
+        data = zlib.compress(self.to_bytes())
+        return base64.b64encode(data).decode('ascii')
+
+    def __setstate__(self, state):
+        data = zlib.decompress(base64.b64decode(state))
+        other = ProblemSet.from_bytes(data)
+        for name in self.__slots__:
+            setattr(self, name, getattr(other, name))
+
+def gen_proposed_batch(answers, dev_vals, dev_probs=None,
+                       pos_only=False, rng=None, exclude=None):
+    """
+    Generate random proposed answers for many problems at once.
+
+    Inputs
+    ------
+    answers : array_like
+        Actual answer to each problem.
     dev_vals : list of numbers
+        Possible deviations of the proposed answer from the actual
+        answer.
     dev_probs : list of numbers
+        Probability of each deviation. Default is to use each
+        deviation equally often.
     pos_only : bool
+        If true, proposed answers must be greater than zero.
+        Deviations that would give a proposed answer of zero or less
+        are excluded for that problem, and the probabilities of the
+        remaining deviations are renormalized.
+    rng : seed or numpy.random.RandomState
+        Source of random numbers (see get_rng).
+    exclude : numpy.ndarray
+        [n_problems x n_deviations] boolean array that is true for
+        deviations that may not be used for a problem (e.g. because
+        that pairing was used before).
 
     Outputs
     -------
-    proposed : number
+    proposed : numpy.ndarray
+        Proposed answer for each problem.
     """
+
+    answers = numpy.asarray(answers)
+    dev_vals = numpy.asarray(dev_vals)
     if dev_probs is None:
         # default is using each deviation equally often
         dev_probs = numpy.ones(len(dev_vals)) / len(dev_vals)
 
-    # transform probilities of the different deviations, for ease of
-    # randomly choosing between them
-    dev_ranges = numpy.cumsum(dev_probs)
+    # weight of each deviation for each problem
+    candidates = answers[:,numpy.newaxis] + dev_vals
+    weights = numpy.tile(numpy.asarray(dev_probs, dtype=float),
+                         (len(answers), 1))
+    if pos_only:
+        weights[candidates <= 0] = 0
+    if exclude is not None:
+        weights[exclude] = 0
 
-    good_answer = False
-    max_tries = 1000
-    n_tries = 0
-    while not good_answer:
-        if n_tries > max_tries:
-            break
+    # transform weights to cumulative probabilities, for ease of
+    # randomly choosing between deviations
+    dev_ranges = numpy.cumsum(weights, axis=1)
+    total = dev_ranges[:,-1:]
+    if numpy.any(total <= 0):
+        raise ValueError("Failed to generate an acceptable "
+                         "proposed answer to a math problem.")
+    dev_ranges /= total
 
-        # choose a random deviation to add to the actual answer
-        dev_ind = numpy.nonzero(dev_ranges >= numpy.random.uniform(0,1))
-        if isinstance(dev_ind, tuple):
-            dev_ind = dev_ind[0]
-        dev_ind = min(dev_ind)
-        dev = dev_vals[dev_ind]
+    # choose the first deviation whose range includes a random draw
+    draws = get_rng(rng).random_sample((len(answers), 1))
+    dev_ind = numpy.sum(dev_ranges <= draws, axis=1)
 
-        # create a proposed answer
-        proposed = answer + dev
-        
-        n_tries += 1
-        if pos_only and proposed <= 0:
-            # require a positive number; try again
-            continue
-        else:
-            good_answer = True
-    
-    if not good_answer:
-        raise standardError("Failed to generate an acceptible "
-                            "proposed answer to a math problem.")
+    return candidates[numpy.arange(len(answers)), dev_ind]
 
-    return proposed
+def gen_proposed(answer, dev_vals, dev_probs=None, pos_only=False,
+                 rng=None):
+    """
+    Generate a random proposed answer to a problem.
+
+    Inputs
+    ------
+    answer : number
+    dev_vals : list of numbers
+    dev_probs : list of numbers
+    pos_only : bool
+    rng : seed or numpy.random.RandomState
+
+    Outputs
+    -------
+    proposed : number
+    """
+
+    return gen_proposed_batch([answer], dev_vals, dev_probs,
+                              pos_only, rng).tolist()[0]
+
+def _used_pairings(registry, terms, op_codes, answers, dev_vals):
+    """
+    Find deviations whose pairing with a problem has been used.
+
+    Outputs
+    -------
+    used : numpy.ndarray
+        [n_problems x n_deviations] boolean array that is true where
+        the pairing of the problem with answer + deviation is in
+        registry.
+    """
+
+    answers = numpy.asarray(answers)
+    used = numpy.zeros((len(answers), len(dev_vals)), dtype=bool)
+    for j, dev in enumerate(dev_vals):
+        used[:,j] = registry.used(problem_keys(terms, op_codes,
+                                               answers + dev))
+    return used
+
+def _exhausted_problems(registry, dev_vals, dev_probs=None,
+                        pos_only=False):
+    """
+    Find problems that have no unused pairings with proposed answers.
+
+    Inputs
+    ------
+    registry : ProblemRegistry
+        Registry of used pairings (registry.pairs is true).
+    dev_vals, dev_probs, pos_only
+        Options for proposed answers (see gen_proposed_batch).
+
+    Outputs
+    -------
+    exhausted : ProblemRegistry
+        Registry of problems whose pairings with every deviation that
+        may be drawn have all been used.
+    """
+
+    # group used pairings by problem; the last four bytes of a key
+    # are the proposed answer
+    problems = {}
+    for key in registry:
+        problems.setdefault(len(key) - 4, set()).add(key[:-4])
+
+    exhausted = ProblemRegistry()
+    for size, keys in problems.items():
+        keys = list(keys)
+        rows = numpy.frombuffer(b''.join(keys), dtype='<i4').reshape(
+            len(keys), size // 4)
+        n_terms = (rows.shape[1] + 1) // 2
+        terms = rows[:,:n_terms]
+        op_codes = rows[:,n_terms:]
+        answers = eval_problem_batch(terms, op_codes)
+
+        # deviations that could still be drawn for each problem
+        allowed = numpy.ones((len(keys), len(dev_vals)), dtype=bool)
+        if dev_probs is not None:
+            allowed &= numpy.asarray(dev_probs) > 0
+        if pos_only:
+            allowed &= answers[:,None] + numpy.asarray(dev_vals) > 0
+        allowed &= ~_used_pairings(registry, terms, op_codes, answers,
+                                   dev_vals)
+        exhausted.add(k for k, a in zip(keys, allowed) if not a.any())
+    return exhausted
+
+def admission_threshold(remaining, minProblemTime, numVars=None,
+                        presentSeq=False, numberDuration=0, numberISI=0,
+                        probISI=0, probJitter=0):
+    """
+    Time that must be left in a period to start another problem.
+
+    This is the rule used by math_distract.run_math_set. If
+    presentSeq is True, the time taken to present the numVars terms
+    is added to minProblemTime. If there is time for at least one
+    problem (based on the time remaining at the start of the
+    period), the maximum ISI between problems is also added, since
+    it applies to every problem after the first.
+
+    Inputs
+    ------
+    remaining : int
+        Time (ms) remaining at the start of the period.
+    minProblemTime : int
+        Minimum time (ms) needed to respond to a problem.
+    numVars : int
+        Number of terms in each problem. If None, the presentation
+        time is not added.
+
+    Outputs
+    -------
+    threshold : int
+        A problem is presented only if more than this much time
+        (ms) remains.
+    """
+
+    if presentSeq and numVars is not None:
+        minProblemTime += (numberDuration + numberISI) * (numVars + 1)
+    if remaining > (minProblemTime + probISI + probJitter):
+        minProblemTime += probISI + probJitter
+    return minProblemTime
+
+def max_problems(maxDistracterLimit, minProblemTime, numVars,
+                 presentSeq=False, numberDuration=0, numberISI=0,
+                 probISI=0, probJitter=0, minResponseTime=0,
+                 showEquals=False):
+    """
+    Maximum number of problems that could be presented in a period.
+
+    Follows the same rules as math_distract.run_math_set, assuming
+    that every ISI takes its minimum time and that every response is
+    made minResponseTime ms after the problem is shown. Preparing
+    exactly this many problems means that a period can never run
+    out of problems.
+
+    Outputs
+    -------
+    n_problems : int
+    """
+
+    threshold = admission_threshold(maxDistracterLimit, minProblemTime,
+                                    numVars, presentSeq, numberDuration,
+                                    numberISI, probISI, probJitter)
+
+    # shortest possible time to present and respond to a problem,
+    # and the shortest gap before the next problem
+    duration = minResponseTime
+    if presentSeq:
+        n_items = numVars
+        if showEquals:
+            n_items += 1
+        duration += (numberDuration + numberISI) * n_items
+    if duration + probISI <= 0:
+        raise ValueError("Problems may take no time; set minResponseTime "
+                         "to limit the number of problems.")
+
+    # problem k is admitted if the time left when it is checked is
+    # more than the threshold. The first problem is checked at the
+    # start, and each later one duration + probISI after the last
+    available = maxDistracterLimit - threshold
+    if available <= 0:
+        return 0
+    elif available <= duration:
+        return 1
+    return 1 + int(math.ceil(float(available - duration) /
+                             (duration + probISI)))
+
+# configuration variables used to plan the number of problems
+SCHEDULE_OPTIONS = {'maxDistracterLimit': 'maxDistractorLimit',
+                    'minProblemTime': 'minProblemTime',
+                    'presentSeq': 'presentSeq',
+                    'numberDuration': 'numberDuration',
+                    'numberISI': 'numberISI',
+                    'probISI': 'probISI',
+                    'probJitter': 'probJitter',
+                    'minResponseTime': 'minResponseTime',
+                    'showEquals': 'showEquals'}
+
+def plan_problems(config):
+    """
+    Number of problems to prepare for each period in a config.
+
+    Uses the timing variables in config (maxDistractorLimit,
+    minProblemTime, presentSeq, showEquals, numberDuration, numberISI,
+    probISI, probJitter, and minResponseTime) to find the maximum number of
+    problems that could be presented (see max_problems).
+    """
+
+    kwargs = {}
+    for name, var in SCHEDULE_OPTIONS.items():
+        if hasattr(config, var):
+            kwargs[name] = getattr(config, var)
+    return max_problems(numVars=getattr(config, 'numVars', 2), **kwargs)
+
+# configuration variables used by prep_math_set
+SET_OPTIONS = ('numVars', 'minNum', 'maxNum', 'maxProbs', 'plusAndMinus',
+               'ansMod', 'ansProb', 'tfProblems', 'uniqueVars',
+               'excludeRepeats', 'genMethod', 'cacheDir', 'minAnswer',
+               'maxAnswer', 'nonNegative', 'noCarry', 'minAnswerDiff')
+
+def set_options(config):
+    """
+    Get options for prep_math_set from a configuration object.
+
+    Variables that are not defined in config are left at their
+    defaults. If maxProbs is None, it is set to the maximum number
+    of problems that could fit in a period (see plan_problems).
+    """
+    
+    options = {}
+    for name in SET_OPTIONS:
+        if hasattr(config, name):
+            options[name] = getattr(config, name)
+    if 'maxProbs' in options and options['maxProbs'] is None:
+        options['maxProbs'] = plan_problems(config)
+    return options
 
 def prep_math_set(numVars=2, minNum=1, maxNum=9, maxProbs=100,
                   plusAndMinus=False, ansMod=[0,1,-1,10,-10],
                   ansProb=[.5,.125,.125,.125,.125],
                   tfProblems=False, uniqueVars=False,
-                  excludeRepeats=True):
+                  excludeRepeats=True, genMethod='serial',
+                  cacheDir=None, prevAnswer=None, seed=None,
+                  minAnswer=None, maxAnswer=None, nonNegative=False,
+                  noCarry=False, minAnswerDiff=None, registry=None):
     """
     Prepare math problems based on standard configuration variables.
 
     Designed to work with the the variables used by vcdMathMod.py;
-    also sets the same defaults.
+    also sets the same defaults. genMethod sets the method used by
+    gen_problem_set, and cacheDir sets where problem space indexes
+    are cached. prevAnswer is the answer to the problem before the
+    first one in the set.
+
+    Problems may be constrained to have answers between minAnswer
+    and maxAnswer, no negative intermediate results (nonNegative),
+    and no carrying or borrowing (noCarry); consecutive problems may
+    be required to have answers that differ by at least
+    minAnswerDiff (see make_constraints and gen_problem_set).
+
+    If registry (a ProblemRegistry) is given, problems that are in
+    it are not used, and the problems in the set are added to it. If
+    registry.pairs is true, it is pairings of problems and proposed
+    answers that are not reused instead; a problem is only left out
+    once all of its pairings have been used, and is used at most once
+    in a set.
+
+    seed may be an int, a tuple of ints (e.g. from child_seed), or
+    a numpy.random.RandomState (see get_rng). Problems and proposed
+    answers are drawn from separate child streams of the seed, so
+    the problems do not depend on whether proposed answers are
+    generated.
     """
     
     # set options for math problem generation
@@ -196,15 +1805,11 @@ def prep_math_set(numVars=2, minNum=1, maxNum=9, maxProbs=100,
     else:
         possible_ops = ('+')
     possible_terms = range(minNum, maxNum + 1)
-
-    # generate a set of math problems
-    terms, ops, answers = gen_problem_set(maxProbs, numVars,
-        possible_terms, possible_ops, uniqueVars, excludeRepeats)
-
+    constraints = make_constraints(minAnswer, maxAnswer, nonNegative,
+                                   noCarry)
+    # if only addition, proposed answers must be greater than 0
+    pos_only = not plusAndMinus
     if tfProblems:
-        # if only addition, proposed answers must be greater than 0
-        pos_only = not plusAndMinus
-        
         # check answer generation options
         if len(ansMod) != len(ansProb):
             raise ValueError("ansMod and ansProb must have the "
@@ -212,14 +1817,120 @@ def prep_math_set(numVars=2, minNum=1, maxNum=9, maxProbs=100,
         elif sum(ansProb) != 1.0:
             raise ValueError("ansProb must sum to one.")
 
-        # create a proposed answer for each problem
-        proposed = []
-        for i in range(maxProbs):
-            mod_answer = gen_proposed(answers[i], ansMod, 
-                                      ansProb, pos_only)
-            proposed.append(mod_answer)
+    pairs = registry is not None and registry.pairs and tfProblems
+    if pairs:
+        # problems may repeat, as long as the proposed answer differs;
+        # only problems with no unused pairings left are excluded
+        problem_registry = _exhausted_problems(registry, ansMod, ansProb,
+                                               pos_only)
+    else:
+        problem_registry = registry
+
+    # generate a set of math problems
+    terms, ops, answers = gen_problem_set(maxProbs, numVars,
+        possible_terms, possible_ops, uniqueVars, excludeRepeats,
+        genMethod, cacheDir, prevAnswer, get_rng(child_seed(seed, 0)),
+        constraints, minAnswerDiff, problem_registry)
+
+    if tfProblems:
+        # create a proposed answer for each problem, from the
+        # pairings that have not been used
+        exclude = None
+        if pairs:
+            op_codes = encode_ops(sum(ops, []))
+            exclude = _used_pairings(registry, terms, op_codes, answers,
+                                     ansMod)
+        rng = get_rng(child_seed(seed, 1))
+        proposed = gen_proposed_batch(answers, ansMod, ansProb, pos_only,
+                                      rng, exclude)
+        if pairs:
+            registry.add(problem_keys(terms, op_codes, proposed))
+        proposed = proposed.tolist()
     else:
         # we don't need a proposed answer
         proposed = None
 
     return terms, ops, answers, proposed
+
+def prep_problem_sets(numSets, seed=None, **kwargs):
+    """
+    Prepare a number of problem sets.
+
+    Each set is generated from its own child stream of seed (see
+    child_seed), so set i can be regenerated on its own with
+    prep_math_set(seed=child_seed(seed, i), **kwargs).
+
+    Inputs
+    ------
+    numSets : int
+        Number of sets to prepare.
+    seed : int, tuple of ints, or numpy.random.RandomState
+        Seed for the session. If None, a seed is taken from the
+        operating system.
+    kwargs
+        Options for prep_math_set. If a registry is given, no problem
+        is used in more than one set (sets then depend on the sets
+        before them, so cannot be regenerated on their own).
+
+    Outputs
+    -------
+    problems : ProblemSet
+    """
+
+    if seed is None:
+        seed = random_seed()
+
+    terms = []
+    ops = []
+    answers = []
+    proposed = []
+    for i in range(numSets):
+        set_config = prep_math_set(seed=child_seed(seed, i), **kwargs)
+        terms.append(set_config[0])
+        ops.append(set_config[1])
+        answers.append(set_config[2])
+        proposed.append(set_config[3])
+
+    return ProblemSet.from_lists(terms, ops, answers, proposed)
+
+def iter_math_problems(chunkSize=10, seed=None, **kwargs):
+    """
+    Generate math problems on demand.
+
+    Problems are prepared in small chunks as they are needed, so an
+    unlimited number of problems can be drawn. Repeated answers are
+    excluded across chunk boundaries.
+
+    Inputs
+    ------
+    chunkSize : int
+        Number of problems to prepare at a time.
+    seed : int, tuple of ints, or numpy.random.RandomState
+        Seed for the problems; each chunk is drawn from its own
+        child stream.
+    kwargs
+        Options for prep_math_set (other than maxProbs, prevAnswer,
+        and seed).
+
+    Outputs
+    -------
+    problems : generator
+        Generates (terms, ops, answer, proposed) for each problem.
+        proposed is None unless tfProblems is true.
+    """
+
+    if seed is None:
+        seed = random_seed()
+
+    prev_answer = None
+    chunk = 0
+    while True:
+        terms, ops, answers, proposed = prep_math_set(maxProbs=chunkSize,
+            prevAnswer=prev_answer, seed=child_seed(seed, chunk),
+            **kwargs)
+        chunk += 1
+        if proposed is None:
+            proposed = [None] * len(answers)
+        for problem in zip(terms, ops, answers, proposed):
+            yield problem
+        prev_answer = answers[-1]
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+"""
+Prepare math problem sets for many subjects and sessions in advance.
+
+Sets are generated in parallel using a pool of worker processes, and
+one file is written for each subject and session. Each file holds a
+serialized prep_math.ProblemSet with config.numSets sets; load it
+with prep_math.ProblemSet.from_bytes.
+
+The random seed for each set is derived from the base seed, the
+subject, the session, and the set number, so the output does not
+depend on the number of workers.
+
+Files are named like PyEPL session directories, so distract_pres can
+load them by setting preparedDir in its config to the output
+directory (see prepared_file). If problems are kept unique across a
+subject's sessions, the registry of used problems is also saved in
+each subject's directory, where distract_pres looks for it.
+
+Example:
+python prep_sessions.py config_distract_pres.py subjects.txt -n 2 -j 8
+"""
+
+import os
+import hashlib
+import argparse
+import multiprocessing
+
+import prep_math as prep
+
+class Config(object):
+    """
+    Configuration variables loaded from a Python config file.
+    """
+
+    def __init__(self, filename):
+        variables = {}
+        with open(filename) as f:
+            exec(compile(f.read(), filename, 'exec'), variables)
+        for name, value in variables.items():
+            if not name.startswith('_'):
+                setattr(self, name, value)
+
+def read_subjects(filename):
+    """
+    Read a list of subject identifiers, one per line.
+
+    Blank lines and lines starting with '#' are ignored.
+    """
+    
+    subjects = []
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                subjects.append(line)
+    return subjects
+
+def session_seed(seed, subject, session):
+    """
+    Derive the random seed for one subject and session.
+
+    Each set in the session is then drawn from its own child stream
+    of this seed (see prep_math.child_seed).
+    """
+    
+    digest = hashlib.sha1(subject.encode('utf-8')).hexdigest()
+    return prep.child_seed(prep.child_seed(seed, int(digest, 16)),
+                           session)
+
+# registry of problems used in a subject's sessions, kept in the
+# subject's directory
+REGISTRY_FILE = 'problems_used.npz'
+
+def session_file(out_dir, subject, session):
+    """
+    Path to the prepared problems for one subject and session.
+    """
+    return os.path.join(out_dir, subject, 'session_%d.problems' % session)
+
+def prepared_file(out_dir, session_path):
+    """
+    Path to the prepared problems for a PyEPL session directory.
+
+    PyEPL keeps each session in <subject>/session_<n>, so the
+    problems prepared for it are in the same place under out_dir.
+    """
+    session_path = os.path.normpath(session_path)
+    subject = os.path.basename(os.path.dirname(session_path))
+    return os.path.join(out_dir, subject,
+                        os.path.basename(session_path) + '.problems')
+
+def prep_session(task, registry=None):
+    """
+    Prepare and save the problem sets for one subject and session.
+
+    Inputs
+    ------
+    task : tuple
+        (options, numSets, subject, session, seed, out_dir, unique),
+        where options are keyword arguments to prep_math.prep_math_set
+        and unique sets what must not be reused within the session
+        (see prep_math.make_registry).
+    registry : prep_math.ProblemRegistry
+        Registry of problems used in earlier sessions. If given, it
+        is used instead of creating one for the session.
+
+    Outputs
+    -------
+    filename : str
+        Path to the file that was written.
+    """
+    
+    options, num_sets, subject, session, seed, out_dir, unique = task
+
+    if registry is None:
+        registry = prep.make_registry(unique)
+    problems = prep.prep_problem_sets(num_sets,
+                                      session_seed(seed, subject, session),
+                                      registry=registry, **options)
+
+    # write to a temporary file first, so that an interrupted run
+    # never leaves a partial file
+    filename = session_file(out_dir, subject, session)
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another worker may have created it
+            if not os.path.isdir(dirname):
+                raise
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(problems.to_bytes())
+    os.rename(tmp, filename)
+
+    return filename
+
+def prep_subject(task):
+    """
+    Prepare the sessions for one subject, with no problems reused
+    across sessions.
+
+    Inputs
+    ------
+    task : tuple
+        (options, numSets, subject, sessions, seed, out_dir, unique),
+        as for prep_session, but with a list of sessions.
+
+    Outputs
+    -------
+    filenames : list of strs
+    """
+
+    options, num_sets, subject, sessions, seed, out_dir, unique = task
+    registry = prep.make_registry(unique)
+    filenames = [prep_session((options, num_sets, subject, session, seed,
+                               out_dir, unique), registry)
+                 for session in sessions]
+
+    # save the problems that were used, so that later sessions can
+    # avoid them
+    if filenames:
+        registry.save(os.path.join(out_dir, subject, REGISTRY_FILE))
+    return filenames
+
+def prep_sessions(config, subjects, n_sessions, out_dir, seed=0,
+                  n_workers=None):
+    """
+    Prepare problem sets for a list of subjects and sessions.
+
+    Inputs
+    ------
+    config : object
+        Configuration variables, as in config_distract_pres.py.
+    subjects : list of strs
+    n_sessions : int
+    out_dir : str
+    seed : int
+        Base random seed.
+    n_workers : int
+        Number of worker processes. Default is the number of CPUs.
+        If 1, sets are prepared in this process.
+
+    Outputs
+    -------
+    filenames : list of strs
+        Files that were written.
+    """
+
+    options = prep.set_options(config)
+    unique = getattr(config, 'uniqueProblems', None)
+    if unique is not None and getattr(config, 'uniqueScope',
+                                      'session') == 'subject':
+        # sessions for a subject must be prepared in order
+        func = prep_subject
+        tasks = [(options, config.numSets, subject, range(n_sessions),
+                  seed, out_dir, unique) for subject in subjects]
+    else:
+        func = prep_session
+        tasks = [(options, config.numSets, subject, session, seed,
+                  out_dir, unique)
+                 for subject in subjects for session in range(n_sessions)]
+    
+    if n_workers == 1:
+        results = [func(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        try:
+            results = pool.map(func, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    if func is prep_subject:
+        return [f for filenames in results for f in filenames]
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Prepare math distraction problem sets for "
+        "multiple subjects and sessions.")
+    parser.add_argument('config', help="configuration file")
+    parser.add_argument('subjects', help="file with one subject per line")
+    parser.add_argument('-n', '--sessions', type=int, default=1,
+                        help="number of sessions per subject")
+    parser.add_argument('-o', '--out-dir', default='prepared',
+                        help="directory to write problem files to")
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help="base random seed")
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    config = Config(args.config)
+    subjects = read_subjects(args.subjects)
+    filenames = prep_sessions(config, subjects, args.sessions,
+                              args.out_dir, args.seed, args.workers)
+    print('Wrote %d files to %s' % (len(filenames), args.out_dir))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+"""
+Quick check that problem generation and presentation run on this
+Python and NumPy.
+
+PyEPL only runs on Python 2, with NumPy 1.16 or earlier, so
+everything it uses must work there as well as on current versions.
+Each step runs a small session or set on the headless backend (see
+headless.py), so PyEPL is not needed.
+
+Example:
+python2 smoke_check.py
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import traceback
+import numpy
+import prep_math
+import headless
+import math_binlog
+import checkpoint
+import config_distract_pres
+
+def check_generation():
+    """Prepare sets with each method, with and without constraints."""
+    for method in ('serial', 'batch', 'index'):
+        for tf in (True, False):
+            prep_math.prep_problem_sets(2, seed=0, maxProbs=10,
+                                        numVars=3, genMethod=method,
+                                        tfProblems=tf)
+        prep_math.prep_math_set(seed=0, maxProbs=10, numVars=2,
+                                genMethod=method, minAnswer=5,
+                                minAnswerDiff=2)
+        registry = prep_math.make_registry('pair')
+        prep_math.prep_problem_sets(3, seed=0, maxProbs=10, numVars=2,
+                                    genMethod=method, tfProblems=True,
+                                    registry=registry)
+
+def _config(**options):
+    """Copy of the default config, with fewer sets and the options."""
+    config = type('Config', (object,), {})()
+    for name in dir(config_distract_pres):
+        if not name.startswith('_'):
+            setattr(config, name, getattr(config_distract_pres, name))
+    config.numSets = 3
+    for name, value in options.items():
+        setattr(config, name, value)
+    return config
+
+def _session(directory, name, **options):
+    path = os.path.join(directory, name)
+    os.mkdir(path)
+    headless.simulate_session(_config(**options), seed=0,
+                              sessionPath=path)
+    return path
+
+def check_session(directory):
+    """Run sessions with the default config and with every option."""
+    _session(directory, 'default')
+    _session(directory, 'typed', tfProblems=False)
+    path = _session(directory, 'options', binaryLog=True,
+                    logMode='thread', deadlineSchedule=True,
+                    timingTolerance=20, logPrep=True,
+                    uniqueProblems='pair', feedback='both')
+    math_binlog.read_binary_log(os.path.join(path, 'math.bin'))
+    checkpoint.CheckpointStore(path).resume()
+    _session(directory, 'ahead', prepMode='ahead')
+
+def main():
+    print('Python %s, NumPy %s' % (sys.version.split()[0],
+                                   numpy.__version__))
+    directory = tempfile.mkdtemp(prefix='smoke_check_')
+    failed = 0
+    try:
+        for name, check in [('generation', check_generation),
+                            ('session', lambda: check_session(directory))]:
+            try:
+                check()
+            except Exception:
+                failed += 1
+                print('%-12s FAILED' % name)
+                traceback.print_exc()
+            else:
+                print('%-12s ok' % name)
+    finally:
+        shutil.rmtree(directory)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())